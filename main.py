@@ -5,25 +5,39 @@ Generic deployment ready (Fly.io removed)
 
 import asyncio
 import pandas as pd
+import numpy as np
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import re
 from io import BytesIO
 from datetime import datetime, timedelta
-from aiogram import Bot, Dispatcher, types, F, Router
+from aiogram import Bot, Dispatcher, types, F, Router, BaseMiddleware
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, BufferedInputFile
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form
 from contextlib import asynccontextmanager
 import os
-import json
+import orjson
 import pytz
 import uuid
+import random
 import time
 import unicodedata
-from typing import Optional, Dict, Any, List, Tuple
+import functools
+import itertools
+import tempfile
+import hashlib
+import hmac
+import importlib.util
+import xlsxwriter
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional, Dict, Any, List, Tuple, Callable
 import logging
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
 import atexit
 import httpx
 
@@ -65,12 +79,14 @@ def load_env_config():
         "AWS_BUCKET": os.getenv("AWS_BUCKET"),
         "PORT": int(os.getenv("PORT", "8000")),
         "SESSION_TIMEOUT": int(os.getenv("SESSION_TIMEOUT", "3600")),
+        "CACHE_TTL": int(os.getenv("CACHE_TTL", "30")),
         "RATE_LIMIT": int(os.getenv("RATE_LIMIT", "5")),
         "RATE_LIMIT_WINDOW": int(os.getenv("RATE_LIMIT_WINDOW", "10")),
         "WEBHOOK_URL": os.getenv("WEBHOOK_URL", ""),
         "TEST_CHAT_ID": os.getenv("TEST_CHAT_ID", ""),
         "ENVIRONMENT": os.getenv("ENVIRONMENT", "production"),
         "BASE_URL": os.getenv("BASE_URL", ""),
+        "PASSWORD_SECRET": os.getenv("PASSWORD_SECRET", ""),
     }
     
     # Validate required configurations
@@ -80,6 +96,11 @@ def load_env_config():
     if not all([config["AWS_ACCESS_KEY_ID"], config["AWS_SECRET_ACCESS_KEY"], config["AWS_BUCKET"]]):
         logger.warning("AWS credentials not fully set. Some features may not work.")
     
+    if not config["PASSWORD_SECRET"]:
+        if config["ENVIRONMENT"] == "production":
+            raise ValueError("❌ PASSWORD_SECRET environment variable not set")
+        logger.warning("PASSWORD_SECRET not set. Password hashes are plain (unkeyed) blake2b; do not use outside development.")
+    
     logger.info(f"✅ Config loaded: BOT_TOKEN present: {bool(config['BOT_TOKEN'])}")
     logger.info(f"🌐 Webhook URL: {config['WEBHOOK_URL'] or 'Not set'}")
     logger.info(f"📦 S3 Bucket: {config['AWS_BUCKET']}")
@@ -96,33 +117,120 @@ AWS_CONFIG = {
     "aws_secret_access_key": CONFIG["AWS_SECRET_ACCESS_KEY"],
     "region_name": CONFIG["AWS_REGION"]
 }
+AWS_BUCKET = CONFIG["AWS_BUCKET"]
+
+S3_CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    tcp_keepalive=True
+)
 
 # ============= S3 KEYS =============
 ACCOUNTS_KEY = "users/accounts.xlsx"
+ACCOUNTS_CSV_KEY = "users/accounts.csv"
 STOCK_KEY = "stock/diamonds.xlsx"
 SUPPLIER_STOCK_FOLDER = "stock/suppliers/"
 COMBINED_STOCK_KEY = "stock/combined/all_suppliers_stock.xlsx"
+# Gzipped CSV copy earlier builds wrote for S3 Select; no longer written, only removed by delete-all
+COMBINED_STOCK_CSV_KEY = "stock/combined/all_suppliers_stock.csv.gz"
+COMBINED_STOCK_PARQUET_KEY = "stock/combined/all_suppliers_stock.parquet"
+STOCK_INDEX_KEY = "stock/index.json"
 ACTIVITY_LOG_FOLDER = "activity_logs/"
+ACTIVITY_ROLLUP_FOLDER = "activity_logs/rollup/"
 DEALS_FOLDER = "deals/"
-DEAL_HISTORY_KEY = "deals/deal_history.xlsx"
+DEALS_INDEX_KEY = "deals/_index.parquet"
+DEAL_HISTORY_FOLDER = "deal_history/"
 NOTIFICATIONS_FOLDER = "notifications/"
 SESSION_KEY = "sessions/logged_in_users.json"
+SESSION_FOLDER = "sessions/users/"
+SESSION_ACTIVITY_KEY = "sessions/last_active.json"
+SUPPLIER_SCHEMA_FOLDER = "stock/schemas/"
+STONE_LOCK_FOLDER = "locks/"
 
 # ============= STARTUP CACHE =============
 startup_cache = {
-    "accounts": None,
     "stock": None,
-    "last_loaded": 0
+    "etag": None,
+    "source": None,
+    # (frame, etag, source) swapped in as one tuple so readers never mix two loads
+    "snapshot": None,
+    "last_loaded": 0,
+    "checked_at": 0
 }
 
+# Stock # -> row position in the cached stock frame
+_STOCK_IDX: Dict[str, int] = {}
+
+MARKET_GROUP_COLS = ["Shape", "Color", "Clarity", "Diamond Type"]
+_MEDIAN_CACHE = {"etag": None, "medians": None}
+
+_ACCOUNTS_CACHE = {"etag": None, "df": None, "checked_at": 0}
+# Lower-cased username -> that account's row as a plain dict
+_ACCOUNTS_IDX: Dict[str, Dict[str, str]] = {}
+ACCOUNT_COLUMNS = ["USERNAME", "PASSWORD", "ROLE", "APPROVED"]
+
 # ============= INITIALIZE AWS CLIENTS =============
+_S3_CLIENT = None
+
+def _get_s3():
+    """Get the shared pooled S3 client, creating it on first use"""
+    global _S3_CLIENT
+    if _S3_CLIENT is None:
+        session = boto3.session.Session(**{k: v for k, v in AWS_CONFIG.items() if v})
+        _S3_CLIENT = session.client("s3", config=S3_CLIENT_CONFIG)
+    return _S3_CLIENT
+
 try:
-    s3 = boto3.client("s3", **{k: v for k, v in AWS_CONFIG.items() if v})
+    s3 = _get_s3()
     logger.info("✅ AWS S3 client initialized")
 except Exception as e:
     logger.error(f"❌ Failed to initialize S3 client: {e}")
     s3 = None
 
+def iter_s3_objects(prefix: str, suffix: str = ""):
+    """Yield every object under prefix, following list pagination"""
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=AWS_BUCKET, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(suffix):
+                yield obj
+
+S3_FETCH_WORKERS = 32
+
+# Shared pool for fanning out small S3 requests; stays under the client's connection pool
+S3_EXECUTOR = ThreadPoolExecutor(max_workers=S3_FETCH_WORKERS, thread_name_prefix="s3")
+
+def _get_body(key: str) -> Optional[bytes]:
+    try:
+        return s3.get_object(Bucket=AWS_BUCKET, Key=key)["Body"].read()
+    except Exception as e:
+        logger.error(f"❌ Failed to fetch {key}: {e}")
+        return None
+
+def fetch_s3_bodies(keys: List[str]) -> List[Optional[bytes]]:
+    """GET many small objects concurrently, returning bodies in key order"""
+    if len(keys) <= 1:
+        return [_get_body(k) for k in keys]
+    return list(S3_EXECUTOR.map(_get_body, keys))
+
+def delete_s3_keys(keys: List[str]) -> int:
+    """Delete keys with batched delete_objects calls (1000 per request), returning the count removed"""
+    deleted = 0
+    for i in range(0, len(keys), 1000):
+        response = s3.delete_objects(
+            Bucket=AWS_BUCKET,
+            Delete={"Objects": [{"Key": key} for key in keys[i:i + 1000]], "Quiet": True}
+        )
+        errors = response.get("Errors", [])
+        for error in errors:
+            logger.error(f"❌ Failed to delete {error.get('Key')}: {error.get('Message')}")
+        deleted += len(keys[i:i + 1000]) - len(errors)
+    return deleted
+
+def to_json(data: Any) -> bytes:
+    """Serialize to compact JSON bytes for S3 bodies"""
+    return orjson.dumps(data, default=str, option=orjson.OPT_SERIALIZE_NUMPY)
+
 # ============= INITIALIZE BOT =============
 bot = Bot(token=CONFIG["BOT_TOKEN"])
 dp = Dispatcher()
@@ -131,8 +239,13 @@ dp.include_router(router)
 
 # ============= GLOBAL DATA STORES =============
 logged_in_users = {}
+# Normalized username -> uid of its most recent session, kept in step with logged_in_users
+_username_index: Dict[str, int] = {}
 user_state = {}
-user_rate_limit = {}
+# Set when a session's last_active moves; the checkpoint loop only writes while it is set
+_sessions_dirty = asyncio.Event()
+# uid -> (tokens, last refill time) for the per-user token bucket
+user_rate_limit: Dict[int, Tuple[float, float]] = {}
 
 # ============= KEYBOARDS =============
 admin_kb = ReplyKeyboardMarkup(
@@ -171,19 +284,47 @@ supplier_kb = ReplyKeyboardMarkup(
     resize_keyboard=True
 )
 
+# ============= CALLBACK DATA =============
+class AccountCB(CallbackData, prefix="acct"):
+    action: str
+    username: str
+
+# Keeps "acct:approve:<username>" within Telegram's 64-byte callback_data limit
+MAX_USERNAME_BYTES = 32
+
 # ============= TEXT CLEANING FUNCTIONS =============
+_WS_RE = re.compile(r"\s+")
+_SPLIT_RE = re.compile(r"\s*,\s*")
+
+def split_grades(value: str) -> List[str]:
+    """Split a comma separated list into lowercase terms, keeping multi-word values like "Fancy Yellow" whole"""
+    return [term for term in (t.strip().lower() for t in _SPLIT_RE.split(value)) if term]
+
 def clean_text(value: Any) -> str:
     """Clean and normalize text values"""
     if value is None:
         return ""
     if isinstance(value, float) and pd.isna(value):
         return ""
-    value = str(value)
-    value = unicodedata.normalize("NFKC", value)
-    value = value.replace("\u00A0", " ").replace("\u200B", "")
-    value = value.replace("\n", " ").replace("\r", " ")
-    value = re.sub(r"\s+", " ", value)
-    return value.strip()
+    value = value if isinstance(value, str) else str(value)
+    
+    # Printable ASCII without double spaces is already normalized (NFKC is a no-op on ASCII)
+    if value.isascii() and value.isprintable() and "  " not in value:
+        return value.strip()
+    
+    # NFKC maps NBSP to a space and _WS_RE covers CR/LF, leaving only zero-width spaces
+    value = unicodedata.normalize("NFKC", value).replace("\u200B", "")
+    return _WS_RE.sub(" ", value).strip()
+
+def clean_series(values: pd.Series) -> pd.Series:
+    """Vectorized clean_text over a whole column"""
+    return (
+        values.fillna("").astype(str)
+        .str.normalize("NFKC")
+        .str.replace("\u200B", "", regex=False)
+        .str.replace(_WS_RE, " ", regex=True)
+        .str.strip()
+    )
 
 def clean_password(val: Any) -> str:
     """Clean password, handling Excel .0 issue"""
@@ -196,20 +337,69 @@ def normalize_text(x: Any) -> str:
     """Normalize text for comparison"""
     return clean_text(x).lower()
 
-def safe_excel(val: Any) -> Any:
-    """Prevent Excel formula injection"""
-    if isinstance(val, str) and val.startswith(("=", "+", "-", "@")):
-        return "'" + val
-    return val
+FORMULA_PREFIXES = ("=", "+", "-", "@")
+
+# Control characters that are not allowed in xlsx cell text
+_XLSX_ILLEGAL_RE = re.compile(r"[\x00-\x08\x0B\x0C\x0E-\x1F]")
+
+def escape_formulas(df: pd.DataFrame) -> pd.DataFrame:
+    """Make text cells Excel-safe in place: drop illegal control characters and quote formulas"""
+    for col in df.select_dtypes(include="object"):
+        try:
+            dirty = df[col].str.contains(_XLSX_ILLEGAL_RE, na=False)
+        except AttributeError:
+            continue  # column holds no strings
+        if dirty.any():
+            df.loc[dirty, col] = df.loc[dirty, col].str.replace(_XLSX_ILLEGAL_RE, "", regex=True)
+        
+        mask = df[col].str.startswith(FORMULA_PREFIXES, na=False)
+        if mask.any():
+            df.loc[mask, col] = "'" + df.loc[mask, col]
+    return df
+
+# ============= PASSWORD HASHING =============
+PASSWORD_HASH_PREFIX = "b2$"
+# blake2b keys are limited to 64 bytes, so derive a fixed-size key from the secret;
+# without a secret (development only) hashes are unkeyed rather than keyed with a derived public value
+_PASSWORD_KEY = hashlib.blake2b(CONFIG["PASSWORD_SECRET"].encode()).digest() if CONFIG["PASSWORD_SECRET"] else b""
+
+def hash_password(password: Any) -> str:
+    """Hash a password with keyed blake2b"""
+    digest = hashlib.blake2b(clean_password(password).encode(), digest_size=16, key=_PASSWORD_KEY).hexdigest()
+    return f"{PASSWORD_HASH_PREFIX}{digest}"
+
+def is_password_hashed(stored: str) -> bool:
+    return stored.startswith(PASSWORD_HASH_PREFIX)
+
+def verify_password(stored: str, password: Any) -> bool:
+    """Check a password against a stored hash or a legacy plaintext value"""
+    if not is_password_hashed(stored):
+        return hmac.compare_digest(stored.encode(), clean_password(password).encode())
+    
+    return hmac.compare_digest(stored.encode(), hash_password(password).encode())
 
 # ============= USER MANAGEMENT FUNCTIONS =============
+def set_session(uid: int, user_data: Dict[str, Any]):
+    """Register a logged-in session and index it by username"""
+    logged_in_users[uid] = user_data
+    _username_index[normalize_text(user_data.get("USERNAME", ""))] = uid
+
+def drop_session(uid: int) -> Optional[Dict[str, Any]]:
+    """Remove a session from memory and from the username index"""
+    user_data = logged_in_users.pop(uid, None)
+    if user_data:
+        username = normalize_text(user_data.get("USERNAME", ""))
+        if _username_index.get(username) == uid:
+            _username_index.pop(username, None)
+    return user_data
+
 def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
     """Get user by username from logged_in_users"""
-    username = normalize_text(username)
-    for uid, user_data in logged_in_users.items():
-        if normalize_text(user_data.get("USERNAME", "")) == username:
-            return {"TELEGRAM_ID": uid, **user_data}
-    return None
+    uid = _username_index.get(normalize_text(username))
+    user_data = logged_in_users.get(uid)
+    if user_data is None:
+        return None
+    return {"TELEGRAM_ID": uid, **user_data}
 
 def is_admin(user: Optional[Dict[str, Any]]) -> bool:
     """Check if user is admin - ONLY based on Excel file"""
@@ -227,45 +417,109 @@ def get_logged_user(uid: int) -> Optional[Dict[str, Any]]:
 
     last_active = user.get("last_active", 0)
     if time.time() - last_active > CONFIG["SESSION_TIMEOUT"]:
-        logged_in_users.pop(uid, None)
-        save_sessions()
+        drop_session(uid)
+        # Handlers call this on the event loop, so drop the S3 copy in the background
+        S3_EXECUTOR.submit(delete_session, uid)
         return None
 
     user["last_active"] = time.time()
+    _sessions_dirty.set()
     return user
 
-def touch_session(uid: int):
-    """Update user's last active time"""
-    if uid in logged_in_users:
-        logged_in_users[uid]["last_active"] = time.time()
-        save_sessions()
-
 # ============= SESSION MANAGEMENT =============
+def save_session(uid: int):
+    """Save one user's session to its own S3 key"""
+    try:
+        if s3 and uid in logged_in_users:
+            s3.put_object(
+                Bucket=AWS_BUCKET,
+                Key=f"{SESSION_FOLDER}{uid}.json",
+                Body=to_json(logged_in_users[uid]),
+                ContentType="application/json"
+            )
+    except Exception as e:
+        logger.error(f"❌ Failed to save session {uid}: {e}")
+
+def delete_session(uid: int):
+    """Remove one user's session from S3"""
+    try:
+        if s3:
+            s3.delete_object(Bucket=AWS_BUCKET, Key=f"{SESSION_FOLDER}{uid}.json")
+    except Exception as e:
+        logger.error(f"❌ Failed to delete session {uid}: {e}")
+
 def save_sessions():
-    """Save sessions to S3"""
+    """Checkpoint every session's last activity time in a single S3 write"""
     try:
         if s3:
             s3.put_object(
-                Bucket=CONFIG["AWS_BUCKET"],
-                Key=SESSION_KEY,
-                Body=json.dumps(logged_in_users, default=str),
+                Bucket=AWS_BUCKET,
+                Key=SESSION_ACTIVITY_KEY,
+                Body=to_json({str(uid): data.get("last_active", 0) for uid, data in logged_in_users.items()}),
                 ContentType="application/json"
             )
     except Exception as e:
         logger.error(f"❌ Failed to save sessions: {e}")
 
+def _read_json(key: str) -> Any:
+    return orjson.loads(s3.get_object(Bucket=AWS_BUCKET, Key=key)["Body"].read())
+
+def _migrate_legacy_sessions() -> Dict[int, Dict[str, Any]]:
+    """Move sessions from the old single-file store to per-user keys"""
+    try:
+        raw = _read_json(SESSION_KEY)
+    except Exception:
+        return {}
+    
+    sessions = {int(k): v for k, v in raw.items()}
+    for uid, data in sessions.items():
+        s3.put_object(
+            Bucket=AWS_BUCKET,
+            Key=f"{SESSION_FOLDER}{uid}.json",
+            Body=to_json(data),
+            ContentType="application/json"
+        )
+    s3.delete_object(Bucket=AWS_BUCKET, Key=SESSION_KEY)
+    logger.info(f"✅ Migrated {len(sessions)} sessions to per-user keys")
+    return sessions
+
 def load_sessions():
-    """Load sessions from S3"""
+    """Load per-user sessions from S3"""
     global logged_in_users
     try:
         if s3:
-            obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=SESSION_KEY)
-            raw = json.loads(obj["Body"].read())
-            logged_in_users = {int(k): v for k, v in raw.items()}
+            sessions = _migrate_legacy_sessions()
+            
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                futures = {
+                    executor.submit(_read_json, obj["Key"]): obj["Key"]
+                    for obj in iter_s3_objects(SESSION_FOLDER, ".json")
+                }
+                for future in as_completed(futures):
+                    uid = int(futures[future][len(SESSION_FOLDER):-len(".json")])
+                    try:
+                        sessions[uid] = future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to read session {uid}: {e}")
+            
+            try:
+                checkpoint = _read_json(SESSION_ACTIVITY_KEY)
+            except Exception:
+                checkpoint = {}
+            
+            for uid, last_active in checkpoint.items():
+                if int(uid) in sessions:
+                    sessions[int(uid)]["last_active"] = last_active
+            
+            logged_in_users = sessions
+            _username_index.clear()
+            for uid, data in sorted(sessions.items(), key=lambda item: item[1].get("last_active", 0)):
+                _username_index[normalize_text(data.get("USERNAME", ""))] = uid
             logger.info(f"✅ Loaded {len(logged_in_users)} sessions from S3")
     except Exception as e:
         logger.warning(f"⚠️ No existing sessions or error loading: {e}")
         logged_in_users = {}
+        _username_index.clear()
 
 def cleanup_sessions():
     """Remove expired sessions"""
@@ -276,69 +530,186 @@ def cleanup_sessions():
         if now - data.get("last_active", now) > CONFIG["SESSION_TIMEOUT"]:
             expired.append(uid)
     
+    removed = []
     for uid in expired:
-        user_data = logged_in_users.pop(uid, None)
+        user_data = drop_session(uid)
         if user_data:
+            removed.append(uid)
             log_activity(user_data, "SESSION_EXPIRED")
     
-    if expired:
-        save_sessions()
+    if removed and s3:
+        try:
+            delete_s3_keys([f"{SESSION_FOLDER}{uid}.json" for uid in removed])
+        except Exception as e:
+            logger.error(f"❌ Failed to delete {len(removed)} expired sessions: {e}")
 
 # ============= RATE LIMITING =============
 def is_rate_limited(uid: int) -> bool:
-    """Check if user is rate limited"""
+    """Check if user is rate limited (token bucket refilled at RATE_LIMIT per window)"""
     now = time.time()
-    window = CONFIG["RATE_LIMIT_WINDOW"]
     limit = CONFIG["RATE_LIMIT"]
     
-    history = user_rate_limit.get(uid, [])
-    history = [t for t in history if now - t < window]
+    tokens, last = user_rate_limit.get(uid, (limit, now))
+    tokens = min(limit, tokens + (now - last) * limit / CONFIG["RATE_LIMIT_WINDOW"])
     
-    if len(history) >= limit:
+    if tokens < 1:
+        user_rate_limit[uid] = (tokens, now)
         return True
     
-    history.append(now)
-    user_rate_limit[uid] = history[-10:]
+    user_rate_limit[uid] = (tokens - 1, now)
     return False
 
+class SessionMiddleware(BaseMiddleware):
+    """Rate-limit every incoming message and refresh the sender's session in one place"""
+    
+    async def __call__(self, handler, event: types.Message, data: Dict[str, Any]) -> Any:
+        if event.from_user:
+            uid = event.from_user.id
+            if is_rate_limited(uid):
+                await event.reply("⏳ Too many messages. Please slow down.")
+                return None
+            
+            # Expires stale sessions and stamps last_active on live ones; handlers take it as `user`
+            data["user"] = get_logged_user(uid)
+        
+        return await handler(event, data)
+
+dp.message.outer_middleware(SessionMiddleware())
+
 # ============= DATA LOADING/SAVING =============
-def load_accounts(cached=True) -> pd.DataFrame:
-    """Load accounts from Excel file in S3 with caching"""
-    global startup_cache
+# python-calamine parses xlsx in Rust, several times faster than openpyxl
+EXCEL_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else "openpyxl"
+
+# openpyxl streams rows in read-only mode instead of building the full workbook DOM
+OPENPYXL_READ_KWARGS = {"read_only": True, "data_only": True}
+
+def _read_excel(source: Any, **kwargs) -> pd.DataFrame:
+    """Read an Excel file with the fastest available engine"""
+    if EXCEL_ENGINE == "calamine":
+        try:
+            return pd.read_excel(source, engine="calamine", **kwargs)
+        except (ValueError, TypeError):
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ calamine could not read workbook, retrying with openpyxl: {e}")
+            if hasattr(source, "seek"):
+                source.seek(0)
+    
+    return pd.read_excel(source, engine="openpyxl", engine_kwargs=OPENPYXL_READ_KWARGS, **kwargs)
+
+# Rows formatted per batch when rendering large CSV exports
+CSV_CHUNK_ROWS = 50000
+
+def csv_bytes(df: pd.DataFrame) -> bytes:
+    """Render a DataFrame to CSV in memory"""
+    return df.to_csv(index=False, chunksize=CSV_CHUNK_ROWS).encode("utf-8")
+
+def write_excel(df: pd.DataFrame, target: Any, sheet_name: str = "Sheet1"):
+    """Stream a DataFrame to xlsx row by row, keeping only one row in memory"""
+    workbook = xlsxwriter.Workbook(target, {
+        "constant_memory": True,
+        "nan_inf_to_errors": True,
+        "strings_to_formulas": False,
+        "strings_to_urls": False,
+        "remove_timezone": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss"
+    })
+    worksheet = workbook.add_worksheet(sheet_name)
+    worksheet.write_row(0, 0, [str(col) for col in df.columns])
     
+    # constant_memory flushes each row once the next starts, so rows must go in order
+    values = df.astype(object).where(df.notna(), None)
+    for row_num, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_num, 0, row)
+    
+    workbook.close()
+
+def excel_bytes(df: pd.DataFrame, sheet_name: str = "Sheet1") -> bytes:
+    """Render a DataFrame to xlsx in memory"""
+    buffer = BytesIO()
+    write_excel(df, buffer, sheet_name)
+    return buffer.getvalue()
+
+def put_excel(df: pd.DataFrame, key: str) -> Dict[str, Any]:
+    """Render a DataFrame to xlsx in memory and upload it to S3 without a temp file"""
+    return s3.put_object(Bucket=AWS_BUCKET, Key=key, Body=excel_bytes(df))
+
+def _normalize_accounts(df: pd.DataFrame) -> pd.DataFrame:
+    """Validate and clean the account columns"""
+    for col in ACCOUNT_COLUMNS:
+        if col not in df.columns:
+            raise ValueError(f"Missing required column: {col}")
+        
+        df[col] = clean_series(df[col])
+    
+    # Same as clean_password: Excel turns numeric passwords into "1234.0"
+    df["PASSWORD"] = df["PASSWORD"].str.replace(r"\.0$", "", regex=True)
+    df["ROLE"] = df["ROLE"].str.lower()
+    df["APPROVED"] = df["APPROVED"].str.upper()
+    return df
+
+def _cache_accounts(df: pd.DataFrame, etag: Optional[str]):
+    """Cache the accounts frame and its username index"""
+    global _ACCOUNTS_IDX
+    df = df.reset_index(drop=True)
+    _ACCOUNTS_IDX = {row["USERNAME"].lower(): row for row in df.to_dict("records")}
+    _ACCOUNTS_CACHE["etag"] = etag
+    _ACCOUNTS_CACHE["df"] = df
+    _ACCOUNTS_CACHE["checked_at"] = time.time()
+
+def find_account(username: str) -> Optional[Dict[str, str]]:
+    """Look up a cached account by username, case-insensitively"""
+    row = _ACCOUNTS_IDX.get(clean_text(username).lower())
+    return dict(row) if row is not None else None
+
+def _load_accounts_xlsx() -> pd.DataFrame:
+    """Read the legacy Excel accounts file (used once to seed the CSV store)"""
+    obj = s3.get_object(Bucket=AWS_BUCKET, Key=ACCOUNTS_KEY)
+    return _read_excel(BytesIO(obj["Body"].read()), dtype=str)
+
+def load_accounts(cached=True, copy=True) -> pd.DataFrame:
+    """Load accounts from the CSV store in S3, re-downloading only when the ETag changes"""
+    # Read-only callers pass copy=False and share the cached frame; writers get their own copy
+    share = (lambda df: df.copy()) if copy else (lambda df: df)
     try:
-        if cached and startup_cache["accounts"] is not None and (time.time() - startup_cache["last_loaded"]) < 300:
-            return startup_cache["accounts"]
-            
         if not s3:
-            return pd.DataFrame(columns=["USERNAME", "PASSWORD", "ROLE", "APPROVED"])
-            
-        local_path = "/tmp/accounts.xlsx"
-        s3.download_file(CONFIG["AWS_BUCKET"], ACCOUNTS_KEY, local_path)
-        df = pd.read_excel(local_path, dtype=str)
+            return pd.DataFrame(columns=ACCOUNT_COLUMNS)
         
-        required_cols = ["USERNAME", "PASSWORD", "ROLE", "APPROVED"]
-        for col in required_cols:
-            if col not in df.columns:
-                raise ValueError(f"Missing required column: {col}")
-            
-            df[col] = df[col].fillna("").astype(str).apply(clean_text)
+        # Within the TTL, trust the cache without even a HEAD request
+        if cached and _ACCOUNTS_CACHE["df"] is not None and time.time() - _ACCOUNTS_CACHE["checked_at"] < CONFIG["CACHE_TTL"]:
+            return share(_ACCOUNTS_CACHE["df"])
         
-        df["PASSWORD"] = df["PASSWORD"].apply(clean_password)
+        try:
+            head = s3.head_object(Bucket=AWS_BUCKET, Key=ACCOUNTS_CSV_KEY)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+                raise
+            logger.info("ℹ️ No accounts CSV yet, migrating from Excel")
+            df = _normalize_accounts(_load_accounts_xlsx())
+            _cache_accounts(df, None)
+            save_accounts(df)
+            return share(_ACCOUNTS_CACHE["df"])
+        
+        if cached and _ACCOUNTS_CACHE["df"] is not None and head["ETag"] == _ACCOUNTS_CACHE["etag"]:
+            _ACCOUNTS_CACHE["checked_at"] = time.time()
+            return share(_ACCOUNTS_CACHE["df"])
+        
+        obj = s3.get_object(Bucket=AWS_BUCKET, Key=ACCOUNTS_CSV_KEY)
+        df = pd.read_csv(BytesIO(obj["Body"].read()), dtype=str, keep_default_na=False)
+        df = _normalize_accounts(df)
         
         logger.info(f"✅ Loaded {len(df)} accounts from S3")
         
-        startup_cache["accounts"] = df
-        startup_cache["last_loaded"] = time.time()
+        _cache_accounts(df, obj["ETag"])
         
-        return df
+        return share(_ACCOUNTS_CACHE["df"])
         
     except Exception as e:
         logger.error(f"❌ Failed to load accounts: {e}")
-        return pd.DataFrame(columns=["USERNAME", "PASSWORD", "ROLE", "APPROVED"])
+        return pd.DataFrame(columns=ACCOUNT_COLUMNS)
 
 def save_accounts(df: pd.DataFrame):
-    """Save accounts to Excel file in S3"""
+    """Save accounts to the CSV store in S3"""
     if READ_ONLY_ACCOUNTS:
         logger.warning("⚠️ Accounts file is READ ONLY. Skipping save.")
         return
@@ -347,49 +718,275 @@ def save_accounts(df: pd.DataFrame):
         if not s3:
             logger.error("❌ S3 client not available")
             return
-            
-        local_path = "/tmp/accounts.xlsx"
-        df.to_excel(local_path, index=False)
-        s3.upload_file(local_path, CONFIG["AWS_BUCKET"], ACCOUNTS_KEY)
+        
+        buffer = BytesIO()
+        df.to_csv(buffer, index=False)
+        response = s3.put_object(
+            Bucket=AWS_BUCKET,
+            Key=ACCOUNTS_CSV_KEY,
+            Body=buffer.getvalue(),
+            ContentType="text/csv"
+        )
         logger.info(f"✅ Saved {len(df)} accounts to S3")
         
-        startup_cache["accounts"] = df
-        startup_cache["last_loaded"] = time.time()
+        _cache_accounts(df.copy(), response["ETag"])
         
     except Exception as e:
         logger.error(f"❌ Failed to save accounts: {e}")
 
-def load_stock(cached=True) -> pd.DataFrame:
-    """Load combined stock from S3 with caching"""
-    global startup_cache
+def add_account(row: Dict[str, str]) -> pd.DataFrame:
+    """Append one account and save, building the new table straight from the cached frame"""
+    df = load_accounts(copy=False)
+    df = pd.concat([df, pd.DataFrame([row], columns=df.columns)], ignore_index=True)
+    save_accounts(df)
+    return df
+
+def set_account_password(username: str, password: Any):
+    """Store a hashed password for an account (upgrades legacy plaintext)"""
+    df = load_accounts()
+    mask = df["USERNAME"].str.lower() == username.lower()
+    if not mask.any():
+        return
+    
+    df.loc[mask, "PASSWORD"] = hash_password(password)
+    save_accounts(df)
+    logger.info(f"🔐 Upgraded password hash for {username}")
+
+def authenticate_user(username: str, password: Any) -> Optional[Dict[str, str]]:
+    """Return the approved account matching the credentials, or None"""
+    account = find_account(username)
+    if account is None or account["APPROVED"] != "YES":
+        return None
+    
+    if not verify_password(account["PASSWORD"], password):
+        return None
+    
+    # Upgrade plaintext and legacy-key hashes to the current key
+    if account["PASSWORD"] != hash_password(password):
+        set_account_password(account["USERNAME"], password)
+    
+    return account
+
+def export_accounts_xlsx(df: pd.DataFrame) -> bytes:
+    """Materialize the accounts as an Excel file for admin download"""
+    return excel_bytes(df)
+
+# Stock column -> stripped, lowercased categorical copy added at load time for filters
+STOCK_HELPER_COLUMNS = {
+    "Shape": "_shape_l",
+    "Color": "_color_l",
+    "Clarity": "_clarity_l",
+    "Diamond Type": "_dtype_l",
+    "SUPPLIER": "_supplier_l",
+}
+
+def drop_helper_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Strip the load-time helper columns before a frame is saved or exported"""
+    return df.drop(columns=list(STOCK_HELPER_COLUMNS.values()), errors="ignore")
+
+def _cache_stock(df: pd.DataFrame, etag: Optional[str], source: str = COMBINED_STOCK_PARQUET_KEY) -> pd.DataFrame:
+    """Coerce numeric stock columns once and make df the cached stock"""
+    global _STOCK_IDX
+    for col in ("Weight", "Price Per Carat"):
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors="coerce")
     
+    for col, helper in STOCK_HELPER_COLUMNS.items():
+        if col in df.columns:
+            df[helper] = df[col].astype("string").str.strip().str.lower().astype("category")
+    
+    if "Stock #" in df.columns:
+        ids = df["Stock #"].astype(str).to_numpy()
+        first = ~pd.Series(ids).duplicated().to_numpy()
+        _STOCK_IDX = dict(zip(ids[first], np.flatnonzero(first)))
+    else:
+        _STOCK_IDX = {}
+    
+    startup_cache["snapshot"] = (df, etag, source)
+    startup_cache["stock"] = df
+    startup_cache["etag"] = etag
+    startup_cache["source"] = source
+    startup_cache["last_loaded"] = startup_cache["checked_at"] = time.time()
+    return df
+
+def invalidate_stock_cache():
+    """Drop the cached stock so the next load_stock() re-reads S3"""
+    global _STOCK_IDX
+    startup_cache["snapshot"] = None
+    startup_cache["stock"] = None
+    startup_cache["etag"] = None
+    startup_cache["source"] = None
+    startup_cache["last_loaded"] = startup_cache["checked_at"] = 0
+    _STOCK_IDX = {}
+    _COMBINED_MEMO.update(signature=None, etag=None, df=None)
+
+def find_stone(stone_id: str) -> Optional[Dict[str, Any]]:
+    """Look up a cached stone by Stock # without scanning the frame"""
+    df = startup_cache["stock"]
+    pos = _STOCK_IDX.get(str(stone_id))
+    if df is None or pos is None or pos >= len(df):
+        return None
+    
+    row = df.iloc[pos].to_dict()
+    # Guard against the index and frame being swapped by another thread mid-lookup
+    if str(row.get("Stock #")) != str(stone_id):
+        return None
+    return row
+
+def stock_positions(df: pd.DataFrame, stone_ids: List[str]) -> np.ndarray:
+    """Row positions of stone_ids in a frame derived from the cached stock, via the Stock # index"""
+    ids = df["Stock #"]
+    cached = startup_cache["stock"]
+    found = [(sid, _STOCK_IDX[str(sid)]) for sid in stone_ids if str(sid) in _STOCK_IDX]
+    
+    # The index only matches frames with the cached row order; fall back to a scan otherwise
+    if cached is not None and len(df) == len(cached) and all(
+        pos < len(ids) and str(ids.iat[pos]) == str(sid) for sid, pos in found
+    ):
+        return np.array([pos for _, pos in found], dtype=np.int64)
+    return np.flatnonzero(ids.astype(str).isin([str(sid) for sid in stone_ids]).to_numpy())
+
+def market_medians(df: pd.DataFrame) -> Dict[tuple, float]:
+    """Median price per carat per market group, cached per stock version"""
+    etag = startup_cache["etag"]
+    if etag is not None and _MEDIAN_CACHE["etag"] == etag:
+        return _MEDIAN_CACHE["medians"]
+    
+    medians = df.groupby(MARKET_GROUP_COLS, observed=True, sort=False)["Price Per Carat"].median().to_dict()
+    if etag is not None:
+        _MEDIAN_CACHE["etag"] = etag
+        _MEDIAN_CACHE["medians"] = medians
+    return medians
+
+def _stock_source() -> Tuple[Optional[str], Optional[str]]:
+    """Return (key, etag) of the combined stock, preferring the Parquet copy"""
+    for key in (COMBINED_STOCK_PARQUET_KEY, COMBINED_STOCK_KEY):
+        try:
+            return key, s3.head_object(Bucket=AWS_BUCKET, Key=key)["ETag"]
+        except ClientError:
+            continue
+    return None, None
+
+def grade_match_key(df: pd.DataFrame) -> pd.Series:
+    """Pack the market grade columns into one int64 key, -1 where any grade is missing"""
+    key = np.zeros(len(df), dtype=np.int64)
+    missing = np.zeros(len(df), dtype=bool)
+    
+    for col in MARKET_GROUP_COLS:
+        codes, uniques = pd.factorize(df[col])
+        key = key * (len(uniques) + 1) + codes
+        missing |= codes < 0
+    
+    key[missing] = -1
+    return pd.Series(key, index=df.index)
+
+def load_stock_snapshot(cached=True) -> Tuple[pd.DataFrame, Optional[str], Optional[str]]:
+    """Load combined stock together with the ETag and key of the exact object it was read from"""
     try:
-        if cached and startup_cache["stock"] is not None and (time.time() - startup_cache["last_loaded"]) < 300:
-            return startup_cache["stock"]
-            
         if not s3:
-            return pd.DataFrame()
-            
-        local_path = "/tmp/all_suppliers_stock.xlsx"
-        try:
-            s3.download_file(CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY, local_path)
-            df = pd.read_excel(local_path)
-            logger.info(f"✅ Loaded {len(df)} stock items from S3")
-        except Exception as e:
-            logger.warning(f"⚠️ No combined stock file found: {e}")
-            return pd.DataFrame()
+            return pd.DataFrame(), None, None
         
-        startup_cache["stock"] = df
-        startup_cache["last_loaded"] = time.time()
+        # Read the snapshot once; the cache may be swapped by another thread at any point after
+        snapshot = startup_cache["snapshot"]
         
-        return df
+        # Within the TTL, trust the cache without even a HEAD request
+        if cached and snapshot is not None and time.time() - startup_cache["checked_at"] < CONFIG["CACHE_TTL"]:
+            return snapshot[0].copy(deep=False), snapshot[1], snapshot[2]
+        
+        key, etag = _stock_source()
+        if key is None:
+            logger.warning("⚠️ No combined stock file found")
+            startup_cache["snapshot"] = startup_cache["stock"] = None
+            return pd.DataFrame(), None, None
+        
+        if cached and snapshot is not None and etag == snapshot[1]:
+            startup_cache["checked_at"] = time.time()
+            # Shallow copy so handlers can add derived columns without touching the cache
+            return snapshot[0].copy(deep=False), snapshot[1], snapshot[2]
+        
+        obj = s3.get_object(Bucket=AWS_BUCKET, Key=key)
+        body = BytesIO(obj["Body"].read())
+        df = pd.read_parquet(body) if key == COMBINED_STOCK_PARQUET_KEY else _read_excel(body)
+        logger.info(f"✅ Loaded {len(df)} stock items from S3")
+        
+        return _cache_stock(df, obj["ETag"], key).copy(deep=False), obj["ETag"], key
     except Exception as e:
         logger.warning(f"⚠️ Failed to load stock: {e}")
-        return pd.DataFrame()
+        return pd.DataFrame(), None, None
+
+def load_stock(cached=True) -> pd.DataFrame:
+    """Load combined stock from S3, re-downloading only when its ETag changes"""
+    return load_stock_snapshot(cached)[0]
+
+# ============= SUPPLIER SCHEMA CACHE =============
+@functools.lru_cache(maxsize=128)
+def _schema_for(supplier_key: str) -> Optional[Dict[str, str]]:
+    """Get the column dtypes persisted from the supplier's last upload"""
+    if not s3:
+        return None
+    try:
+        obj = s3.get_object(
+            Bucket=AWS_BUCKET,
+            Key=f"{SUPPLIER_SCHEMA_FOLDER}{supplier_key}.json"
+        )
+        return orjson.loads(obj["Body"].read())
+    except Exception:
+        return None
+
+def save_supplier_schema(supplier_key: str, df: pd.DataFrame):
+    """Persist the column dtypes of an accepted upload for the next read"""
+    try:
+        if not s3:
+            return
+        schema = df.dtypes.astype(str).to_dict()
+        s3.put_object(
+            Bucket=AWS_BUCKET,
+            Key=f"{SUPPLIER_SCHEMA_FOLDER}{supplier_key}.json",
+            Body=to_json(schema),
+            ContentType="application/json"
+        )
+        _schema_for.cache_clear()
+    except Exception as e:
+        logger.warning(f"⚠️ Failed to save schema for {supplier_key}: {e}")
+
+def read_supplier_excel(source: Any, supplier_key: Optional[str] = None) -> pd.DataFrame:
+    """Read a supplier Excel file, skipping dtype inference when the schema is known"""
+    schema = _schema_for(supplier_key) if supplier_key else None
+    if schema:
+        try:
+            return _read_excel(source, dtype=schema)
+        except (ValueError, TypeError) as e:
+            logger.info(f"ℹ️ Schema changed for {supplier_key}, re-inferring: {e}")
+            if hasattr(source, "seek"):
+                source.seek(0)
+    return _read_excel(source)
 
 # ============= ACTIVITY LOGGING =============
+# Set by the lifespan manager while the background log writer is running
+LOG_QUEUE: Optional[asyncio.Queue] = None
+_LOG_LOOP: Optional[asyncio.AbstractEventLoop] = None
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 2
+
+def _write_activity_batch(entries: List[Dict[str, Any]]):
+    """Write queued log entries as one S3 object per user per day"""
+    groups = {}
+    for entry in entries:
+        groups.setdefault((entry["date"], entry["login_id"]), []).append(entry)
+    
+    for (date, login_id), group in groups.items():
+        try:
+            s3.put_object(
+                Bucket=AWS_BUCKET,
+                Key=f"{ACTIVITY_LOG_FOLDER}{date}/{login_id}/{uuid.uuid4().hex}.json",
+                Body=to_json(group),
+                ContentType="application/json"
+            )
+        except Exception as e:
+            logger.error(f"❌ Failed to write activity logs for {login_id}: {e}")
+
 def log_activity(user: Dict[str, Any], action: str, details: Optional[Dict] = None):
-    """Log user activity to S3"""
+    """Queue user activity for the background log writer"""
     try:
         if not s3:
             return
@@ -405,82 +1002,213 @@ def log_activity(user: Dict[str, Any], action: str, details: Optional[Dict] = No
             "telegram_id": user.get("TELEGRAM_ID", "N/A")
         }
         
-        key = f"{ACTIVITY_LOG_FOLDER}{log_entry['date']}/{log_entry['login_id']}.json"
+        if LOG_QUEUE is None:
+            _write_activity_batch([log_entry])
+            return
         
         try:
-            obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=key)
-            data = json.loads(obj["Body"].read())
-        except:
-            data = []
-        
-        data.append(log_entry)
+            on_log_loop = asyncio.get_running_loop() is _LOG_LOOP
+        except RuntimeError:
+            on_log_loop = False
         
-        s3.put_object(
-            Bucket=CONFIG["AWS_BUCKET"],
-            Key=key,
-            Body=json.dumps(data, indent=2),
-            ContentType="application/json"
-        )
+        if on_log_loop:
+            LOG_QUEUE.put_nowait(log_entry)
+        else:
+            _LOG_LOOP.call_soon_threadsafe(LOG_QUEUE.put_nowait, log_entry)
         
     except Exception as e:
         logger.error(f"❌ Failed to log activity: {e}")
 
+def _drain_log_queue(limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    batch = []
+    while not LOG_QUEUE.empty() and (limit is None or len(batch) < limit):
+        batch.append(LOG_QUEUE.get_nowait())
+    return batch
+
+async def activity_log_worker():
+    """Background task batching queued activity logs into S3 writes"""
+    while True:
+        batch = [await LOG_QUEUE.get()]
+        try:
+            await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        except asyncio.CancelledError:
+            # Shutting down: hand the entry back for the final flush
+            LOG_QUEUE.put_nowait(batch[0])
+            raise
+        batch.extend(_drain_log_queue(LOG_BATCH_SIZE - 1))
+        
+        try:
+            await asyncio.to_thread(_write_activity_batch, batch)
+        except Exception as e:
+            logger.error(f"❌ Activity log worker error: {e}")
+
+ACTIVITY_REPORT_COLUMNS = ["Date", "Time", "Login ID", "Role", "Action", "Details"]
+# Rollup rows also record the shard key they came from, so reruns and readers can tell what is covered
+ACTIVITY_SOURCE_COLUMN = "Source"
+_DAY_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+def _activity_rows(body: bytes) -> List[Dict[str, Any]]:
+    """Flatten one activity log object into report rows"""
+    data = orjson.loads(body)
+    # Batches are written as lists; tolerate objects holding a single entry
+    entries = data if isinstance(data, list) else [data]
+    return [
+        {
+            "Date": entry.get("date"),
+            "Time": entry.get("time"),
+            "Login ID": entry.get("login_id"),
+            "Role": entry.get("role"),
+            "Action": entry.get("action"),
+            "Details": to_json(entry.get("details", {})).decode()
+        }
+        for entry in entries
+    ]
+
+def _read_activity_rows(key: str) -> List[Dict[str, Any]]:
+    """Fetch one activity log object as report rows, skipping it if unreadable"""
+    try:
+        return _activity_rows(s3.get_object(Bucket=AWS_BUCKET, Key=key)["Body"].read())
+    except Exception as e:
+        logger.error(f"Failed to read activity file {key}: {e}")
+        return []
+
+def load_activity_report() -> pd.DataFrame:
+    """Combine the daily Parquet rollups with any activity shards not yet rolled up"""
+    rollups = [obj["Key"] for obj in iter_s3_objects(ACTIVITY_ROLLUP_FOLDER, ".parquet")]
+    frames = [pd.read_parquet(BytesIO(body)) for body in fetch_s3_bodies(rollups) if body is not None]
+    
+    # A shard still listed while a rollup is deleting it is already in that day's Parquet
+    covered = set()
+    for frame in frames:
+        if ACTIVITY_SOURCE_COLUMN in frame.columns:
+            covered.update(frame[ACTIVITY_SOURCE_COLUMN].dropna())
+    
+    keys = [obj["Key"] for obj in iter_s3_objects(ACTIVITY_LOG_FOLDER, ".json") if obj["Key"] not in covered]
+    rows = [row for shard in S3_EXECUTOR.map(_read_activity_rows, keys) for row in shard]
+    frames.append(pd.DataFrame(rows, columns=ACTIVITY_REPORT_COLUMNS))
+    
+    return pd.concat([frame.reindex(columns=ACTIVITY_REPORT_COLUMNS) for frame in frames], ignore_index=True)
+
+def rollup_activity_logs() -> int:
+    """Fold each finished day's activity shards into one Parquet file, then delete the shards"""
+    today = datetime.now(IST).strftime("%Y-%m-%d")
+    shards = defaultdict(list)
+    for obj in iter_s3_objects(ACTIVITY_LOG_FOLDER, ".json"):
+        day = obj["Key"][len(ACTIVITY_LOG_FOLDER):].split("/", 1)[0]
+        if _DAY_RE.fullmatch(day) and day < today:
+            shards[day].append(obj["Key"])
+    
+    for day, keys in sorted(shards.items()):
+        rolled, rows = [], []
+        for key, body in zip(keys, fetch_s3_bodies(keys)):
+            try:
+                rows.extend({**row, ACTIVITY_SOURCE_COLUMN: key} for row in _activity_rows(body))
+                rolled.append(key)
+            except Exception as e:
+                # Leave unreadable shards in place rather than deleting data
+                logger.error(f"❌ Skipping activity shard {key}: {e}")
+        
+        if not rolled:
+            continue
+        
+        rollup_key = f"{ACTIVITY_ROLLUP_FOLDER}{day}.parquet"
+        columns = ACTIVITY_REPORT_COLUMNS + [ACTIVITY_SOURCE_COLUMN]
+        frames = [pd.DataFrame(rows, columns=columns)]
+        try:
+            obj = s3.get_object(Bucket=AWS_BUCKET, Key=rollup_key)
+            existing = pd.read_parquet(BytesIO(obj["Body"].read())).reindex(columns=columns)
+            # Shards re-read after an interrupted run replace their earlier rows instead of doubling them;
+            # identical events from different shards (or the same shard) are all kept
+            frames.insert(0, existing[~existing[ACTIVITY_SOURCE_COLUMN].isin(rolled)])
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+                raise
+        
+        df = pd.concat(frames, ignore_index=True)
+        buffer = BytesIO()
+        _parquet_safe(df).to_parquet(buffer, engine="pyarrow", compression="snappy", index=False)
+        s3.put_object(Bucket=AWS_BUCKET, Key=rollup_key, Body=buffer.getvalue())
+        
+        delete_s3_keys(rolled)
+        logger.info(f"✅ Rolled up {len(rolled)} activity shards for {day}")
+    
+    return len(shards)
+
 # ============= NOTIFICATION SYSTEM =============
+def _notification_prefix(username: str, role: str) -> str:
+    return f"{NOTIFICATIONS_FOLDER}{role}_{username}/"
+
 def save_notification(username: str, role: str, message: str):
-    """Save notification for user"""
+    """Save notification for user as a single unread object"""
     try:
         if not s3:
             return
-            
-        key = f"{NOTIFICATIONS_FOLDER}{role}_{username}.json"
-        
-        try:
-            obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=key)
-            data = json.loads(obj["Body"].read())
-        except:
-            data = []
-        
-        data.append({
-            "message": message,
-            "time": datetime.now(IST).strftime("%Y-%m-%d %H:%M"),
-            "read": False
-        })
         
         s3.put_object(
-            Bucket=CONFIG["AWS_BUCKET"],
-            Key=key,
-            Body=json.dumps(data, indent=2),
+            Bucket=AWS_BUCKET,
+            Key=f"{_notification_prefix(username, role)}unread/{time.time_ns()}-{uuid.uuid4().hex[:8]}.json",
+            Body=to_json({
+                "message": message,
+                "time": datetime.now(IST).strftime("%Y-%m-%d %H:%M"),
+                "read": False
+            }),
             ContentType="application/json"
         )
         
     except Exception as e:
         logger.error(f"❌ Failed to save notification: {e}")
 
+def save_notifications_bulk(records: List[Tuple[str, str, str]]):
+    """Save (username, role, message) notifications with concurrent S3 writes"""
+    if s3 and records:
+        list(S3_EXECUTOR.map(lambda record: save_notification(*record), records))
+
+def _fetch_legacy_notifications(username: str, role: str) -> List[Dict]:
+    """Drain unread entries from the old single-file notification store"""
+    key = f"{NOTIFICATIONS_FOLDER}{role}_{username}.json"
+    try:
+        obj = s3.get_object(Bucket=AWS_BUCKET, Key=key)
+        data = orjson.loads(obj["Body"].read())
+    except Exception:
+        return []
+    
+    s3.delete_object(Bucket=AWS_BUCKET, Key=key)
+    return [n for n in data if not n.get("read")]
+
 def fetch_unread_notifications(username: str, role: str) -> List[Dict]:
-    """Fetch unread notifications for user"""
+    """Fetch unread notifications for user and move them to read/"""
     try:
         if not s3:
             return []
-            
-        key = f"{NOTIFICATIONS_FOLDER}{role}_{username}.json"
-        try:
-            obj = s3.get_object(Bucket=CONFIG["AWS_BUCKET"], Key=key)
-            data = json.loads(obj["Body"].read())
-        except:
-            return []
         
-        unread = [n for n in data if not n.get("read")]
+        prefix = _notification_prefix(username, role)
+        unread = _fetch_legacy_notifications(username, role)
         
-        for n in data:
-            n["read"] = True
+        def read_and_archive(key: str) -> Optional[Dict]:
+            try:
+                note = orjson.loads(s3.get_object(Bucket=AWS_BUCKET, Key=key)["Body"].read())
+                s3.copy_object(
+                    Bucket=AWS_BUCKET,
+                    Key=f"{prefix}read/{key.rsplit('/', 1)[-1]}",
+                    CopySource={"Bucket": AWS_BUCKET, "Key": key}
+                )
+                return note
+            except Exception as e:
+                logger.error(f"Failed to read notification {key}: {e}")
+                return None
         
-        s3.put_object(
-            Bucket=CONFIG["AWS_BUCKET"],
-            Key=key,
-            Body=json.dumps(data, indent=2),
-            ContentType="application/json"
-        )
+        keys = [obj["Key"] for obj in iter_s3_objects(f"{prefix}unread/")]
+        archived = []
+        for key, note in zip(keys, S3_EXECUTOR.map(read_and_archive, keys)):
+            if note is not None:
+                unread.append(note)
+                archived.append(key)
         
+        # Only notes already copied to read/ leave unread/, in one batched delete
+        if archived:
+            delete_s3_keys(archived)
+        
+        unread.sort(key=lambda n: n.get("time", ""))
         return unread
         
     except Exception:
@@ -506,34 +1234,27 @@ class DiamondExcelValidator:
         try:
             df.columns = [str(col).strip() for col in df.columns]
             
-            missing_required = []
-            for req_col in DiamondExcelValidator.REQUIRED_COLUMNS:
-                if req_col not in df.columns:
-                    missing_required.append(req_col)
+            missing_required = pd.Index(DiamondExcelValidator.REQUIRED_COLUMNS).difference(df.columns, sort=False).tolist()
             
             if missing_required:
                 errors.append(f'Missing required columns: {", ".join(missing_required)}')
                 return False, pd.DataFrame(), errors, warnings
             
-            missing_optional = []
-            for opt_col in DiamondExcelValidator.OPTIONAL_COLUMNS:
-                if opt_col not in df.columns:
-                    missing_optional.append(opt_col)
+            missing_optional = pd.Index(DiamondExcelValidator.OPTIONAL_COLUMNS).difference(df.columns, sort=False).tolist()
             
             if missing_optional:
                 warnings.append(f'Optional columns not found: {", ".join(missing_optional)}')
             
             df = df.copy()
-            for col in df.columns:
-                if col in df.select_dtypes(include=['object']).columns:
-                    df[col] = df[col].fillna('').astype(str).apply(clean_text)
+            for col in df.select_dtypes(include=['object']).columns:
+                df[col] = clean_series(df[col])
             
-            for req_col in DiamondExcelValidator.REQUIRED_COLUMNS:
-                if req_col in df.columns:
-                    empty_mask = df[req_col].isna() | (df[req_col] == '')
-                    if empty_mask.any():
-                        empty_count = empty_mask.sum()
-                        errors.append(f'{req_col}: {empty_count} rows are empty')
+            required = df[DiamondExcelValidator.REQUIRED_COLUMNS]
+            empty_counts = (required.isna() | required.eq('')).sum()
+            errors.extend(
+                f'{req_col}: {empty_count} rows are empty'
+                for req_col, empty_count in empty_counts[empty_counts > 0].items()
+            )
             
             if 'Stock #' in df.columns:
                 duplicate_mask = df.duplicated('Stock #', keep=False)
@@ -541,25 +1262,14 @@ class DiamondExcelValidator:
                     duplicates = df[duplicate_mask]['Stock #'].unique().tolist()
                     errors.append(f'Duplicate Stock #: {", ".join(duplicates[:5])}')
             
-            if 'Weight' in df.columns:
-                try:
-                    df['Weight'] = pd.to_numeric(df['Weight'], errors='coerce')
-                    invalid_weights = df['Weight'].isna() | (df['Weight'] <= 0)
-                    if invalid_weights.any():
-                        invalid_count = invalid_weights.sum()
-                        errors.append(f'Weight: {invalid_count} invalid values')
-                except:
-                    errors.append('Weight: Could not convert to numeric')
-            
-            if 'Price Per Carat' in df.columns:
-                try:
-                    df['Price Per Carat'] = pd.to_numeric(df['Price Per Carat'], errors='coerce')
-                    invalid_prices = df['Price Per Carat'].isna() | (df['Price Per Carat'] <= 0)
-                    if invalid_prices.any():
-                        invalid_count = invalid_prices.sum()
-                        errors.append(f'Price Per Carat: {invalid_count} invalid values')
-                except:
-                    errors.append('Price Per Carat: Could not convert to numeric')
+            # Both numeric columns are required, so coerce and check them in one reduction
+            numeric_cols = ['Weight', 'Price Per Carat']
+            df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors='coerce')
+            invalid_counts = (df[numeric_cols].isna() | df[numeric_cols].le(0)).sum()
+            errors.extend(
+                f'{col}: {invalid_count} invalid values'
+                for col, invalid_count in invalid_counts[invalid_counts > 0].items()
+            )
             
             if errors:
                 return False, pd.DataFrame(), errors, warnings
@@ -568,23 +1278,14 @@ class DiamondExcelValidator:
             df['LOCKED'] = 'NO'
             df['UPLOADED_AT'] = datetime.now(IST).strftime('%Y-%m-%d %H:%M:%S')
             
-            for col in DiamondExcelValidator.ALL_COLUMNS:
-                if col not in df.columns:
-                    df[col] = ''
-            
             desired_order = ['Stock #', 'Shape', 'Weight', 'Color', 'Clarity', 
                            'Price Per Carat', 'Lab', 'Report #', 'Diamond Type', 
                            'Description', 'CUT', 'Polish', 'Symmetry',
                            'SUPPLIER', 'LOCKED', 'UPLOADED_AT']
             
-            for col in desired_order:
-                if col not in df.columns:
-                    df[col] = ''
-            
-            df = df[desired_order]
+            df = df.reindex(columns=desired_order, fill_value='')
             
-            for col in df.select_dtypes(include=['object']).columns:
-                df[col] = df[col].apply(lambda x: safe_excel(x) if isinstance(x, str) else x)
+            escape_formulas(df)
             
             return True, df, errors, warnings
             
@@ -593,296 +1294,684 @@ class DiamondExcelValidator:
             return False, pd.DataFrame(), errors, warnings
 
 # ============= STOCK MANAGEMENT =============
+COMBINED_STOCK_COLUMNS = [
+    'Stock #', 'Shape', 'Weight', 'Color', 'Clarity', 
+    'Price Per Carat', 'Lab', 'Report #', 'Diamond Type', 
+    'Description', 'CUT', 'Polish', 'Symmetry',
+    'SUPPLIER', 'LOCKED', 'UPLOADED_AT'
+]
+
+_COMBINED_STOCK_COLUMN_SET = frozenset(COMBINED_STOCK_COLUMNS)
+# Identifier/flag columns are read as text so they keep leading zeros and skip type inference
+_COMBINED_TEXT_DTYPES = {"Stock #": str, "Report #": str, "LOCKED": str}
+
+_COMBINED_MEMO = {"signature": None, "etag": None, "df": None}
+
+def _parquet_safe(df: pd.DataFrame) -> pd.DataFrame:
+    """Make mixed object columns uniformly string/NA so pyarrow can type them"""
+    df = df.copy(deep=False)
+    for col in df.select_dtypes(include="object"):
+        # Columns that already hold only strings (the common case after a load) are left untouched
+        if pd.api.types.infer_dtype(df[col], skipna=True) not in ("string", "empty"):
+            # Back to object so the Parquet pandas metadata still reads the column as plain str/None
+            df[col] = df[col].astype("string").astype(object)
+    return df
+
+def save_combined_stock(df: pd.DataFrame, excel_copy: bool = True, **conditions):
+    """Write the combined stock to S3 as Parquet (read by the bot) plus an optional xlsx copy"""
+    df = drop_helper_columns(df)
+    buffer = BytesIO()
+    _parquet_safe(df).to_parquet(buffer, engine="pyarrow", compression="snappy", index=False)
+    # conditions (IfMatch / IfNoneMatch) make the Parquet write a compare-and-swap
+    response = s3.put_object(Bucket=AWS_BUCKET, Key=COMBINED_STOCK_PARQUET_KEY, Body=buffer.getvalue(), **conditions)
+    
+    # Lock flips skip the xlsx copy; it is only a download artifact and is refreshed on rebuild
+    if excel_copy:
+        put_excel(escape_formulas(df.copy()), COMBINED_STOCK_KEY)
+    
+    return response
+
+# Error codes S3 returns when an IfMatch / IfNoneMatch write loses a race
+CONDITIONAL_WRITE_FAILURES = ("PreconditionFailed", "412", "ConditionalRequestConflict")
+STOCK_CAS_RETRIES = 5
+
+def cas_update_stock(build: Callable[[pd.DataFrame], Optional[pd.DataFrame]], excel_copy: bool = False) -> Optional[pd.DataFrame]:
+    """Write build(current stock) back only if the stock is unchanged since it was read, retrying on conflicts"""
+    for attempt in range(STOCK_CAS_RETRIES):
+        # The ETag must be the one of the frame build() sees, not whatever the cache holds afterwards
+        current, etag, source = load_stock_snapshot(cached=attempt == 0)
+        df = build(current)
+        if df is None:
+            return None
+        
+        # A stock that was never written as Parquet (or was loaded from the legacy xlsx) must not exist yet
+        conditions = {"IfMatch": etag} if etag and source == COMBINED_STOCK_PARQUET_KEY else {"IfNoneMatch": "*"}
+        try:
+            response = save_combined_stock(df, excel_copy=excel_copy, **conditions)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in CONDITIONAL_WRITE_FAILURES:
+                logger.info(f"ℹ️ Combined stock changed while updating, retrying ({attempt + 1}/{STOCK_CAS_RETRIES})")
+                continue
+            raise
+        
+        # The rebuild memo no longer matches what is stored, so the next rebuild must not short-circuit
+        _COMBINED_MEMO["signature"] = None
+        return _cache_stock(df, response["ETag"])
+    
+    raise RuntimeError(f"Combined stock kept changing after {STOCK_CAS_RETRIES} attempts")
+
+def _read_supplier_stock(key: str) -> pd.DataFrame:
+    """Download one supplier stock file into memory and tag it with its supplier"""
+    obj = s3.get_object(Bucket=AWS_BUCKET, Key=key)
+    df = _read_excel(
+        BytesIO(obj["Body"].read()),
+        usecols=lambda name: name in _COMBINED_STOCK_COLUMN_SET,
+        dtype=_COMBINED_TEXT_DTYPES,
+    )
+    df["SUPPLIER"] = key.split("/")[-1].replace(".xlsx", "").lower()
+    return df
+
+# Supplier file key -> (ETag, parsed frame) so unchanged supplier files are not parsed again
+_SUPPLIER_FRAMES: Dict[str, Tuple[str, pd.DataFrame]] = {}
+
 def rebuild_combined_stock():
     """Rebuild combined stock from all supplier files"""
     try:
         if not s3:
             return
             
-        objs = s3.list_objects_v2(
-            Bucket=CONFIG["AWS_BUCKET"],
-            Prefix=SUPPLIER_STOCK_FOLDER
-        )
+        supplier_objs = list(iter_s3_objects(SUPPLIER_STOCK_FOLDER, ".xlsx"))
         
-        if "Contents" not in objs:
-            empty_df = pd.DataFrame(columns=[
-                'Stock #', 'Shape', 'Weight', 'Color', 'Clarity', 
-                'Price Per Carat', 'Lab', 'Report #', 'Diamond Type', 
-                'Description', 'CUT', 'Polish', 'Symmetry',
-                'SUPPLIER', 'LOCKED', 'UPLOADED_AT'
-            ])
-            
-            local_path = "/tmp/all_suppliers_stock.xlsx"
-            empty_df.to_excel(local_path, index=False)
-            s3.upload_file(local_path, CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY)
-            
-            if os.path.exists(local_path):
-                os.remove(local_path)
+        if not supplier_objs:
+            _swap_rebuilt_stock(pd.DataFrame(columns=COMBINED_STOCK_COLUMNS))
             return
         
-        dfs = []
-        
-        for obj in objs.get("Contents", []):
-            key = obj["Key"]
-            if not key.endswith(".xlsx"):
-                continue
-            
-            try:
-                local_path = f"/tmp/{key.split('/')[-1]}"
-                s3.download_file(CONFIG["AWS_BUCKET"], key, local_path)
-                df = pd.read_excel(local_path)
-                df["SUPPLIER"] = key.split("/")[-1].replace(".xlsx", "").lower()
-                dfs.append(df)
-                
-                if os.path.exists(local_path):
-                    os.remove(local_path)
-                    
-            except Exception as e:
-                logger.error(f"Failed to process {key}: {e}")
-                continue
+        signature = tuple(sorted(
+            (obj["Key"], obj["ETag"], obj["LastModified"]) for obj in supplier_objs
+        ))
+        
+        # Lock flips rewrite the stock without touching supplier files, so the stored ETag must match too
+        if (
+            _COMBINED_MEMO["df"] is not None
+            and signature == _COMBINED_MEMO["signature"]
+            and _stock_source() == (COMBINED_STOCK_PARQUET_KEY, _COMBINED_MEMO["etag"])
+        ):
+            logger.info("ℹ️ Supplier files unchanged, combined stock is up to date")
+            _cache_stock(_COMBINED_MEMO["df"], _COMBINED_MEMO["etag"])
+            return
         
-        if not dfs:
+        etags = {obj["Key"]: obj["ETag"] for obj in supplier_objs}
+        misses = [key for key, etag in etags.items() if _SUPPLIER_FRAMES.get(key, (None,))[0] != etag]
+        
+        if misses:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                futures = {executor.submit(_read_supplier_stock, key): key for key in misses}
+                for future in as_completed(futures):
+                    key = futures[future]
+                    try:
+                        _SUPPLIER_FRAMES[key] = (etags[key], future.result())
+                    except Exception as e:
+                        logger.error(f"Failed to process {key}: {e}")
+        
+        for key in list(_SUPPLIER_FRAMES):
+            if key not in etags:
+                _SUPPLIER_FRAMES.pop(key, None)
+        
+        frames = {key: _SUPPLIER_FRAMES[key][1] for key in etags if key in _SUPPLIER_FRAMES}
+        if not frames:
             return
         
-        final_df = pd.concat(dfs, ignore_index=True)
+        logger.info(f"ℹ️ Re-parsed {len(misses)} of {len(etags)} supplier file(s)")
         
-        desired_columns = [
-            'Stock #', 'Shape', 'Weight', 'Color', 'Clarity', 
-            'Price Per Carat', 'Lab', 'Report #', 'Diamond Type', 
-            'Description', 'CUT', 'Polish', 'Symmetry',
-            'SUPPLIER', 'LOCKED', 'UPLOADED_AT'
-        ]
+        final_df = pd.concat([frames[key] for key in sorted(frames)], ignore_index=True)
         
-        for col in desired_columns:
+        for col in COMBINED_STOCK_COLUMNS:
             if col not in final_df.columns:
                 final_df[col] = ""
         
-        final_df = final_df[desired_columns]
-        
-        local_path = "/tmp/all_suppliers_stock.xlsx"
-        final_df.to_excel(local_path, index=False)
-        s3.upload_file(local_path, CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY)
+        final_df = _swap_rebuilt_stock(final_df[COMBINED_STOCK_COLUMNS])
         
         logger.info(f"✅ Rebuilt combined stock with {len(final_df)} items")
         
-        startup_cache["stock"] = final_df
-        startup_cache["last_loaded"] = time.time()
+        save_stone_index(final_df)
         
-        if os.path.exists(local_path):
-            os.remove(local_path)
+        snapshot = startup_cache["snapshot"]
+        _COMBINED_MEMO["signature"] = signature
+        _COMBINED_MEMO["etag"] = snapshot[1] if snapshot is not None and snapshot[0] is final_df else None
+        _COMBINED_MEMO["df"] = final_df
             
     except Exception as e:
         logger.error(f"❌ Error rebuilding combined stock: {e}")
 
-def atomic_lock_stone(stone_id: str) -> bool:
-    """Atomically lock a stone to prevent race conditions"""
+def _swap_rebuilt_stock(rebuilt: pd.DataFrame) -> pd.DataFrame:
+    """Replace the combined stock with a full rebuild through the compare-and-swap, keeping live locks"""
+    dropped: List[str] = []
+    
+    def build(current: pd.DataFrame) -> pd.DataFrame:
+        nonlocal dropped
+        df = rebuilt.copy()
+        if current.empty or not {"Stock #", "LOCKED"}.issubset(current.columns):
+            return df
+        
+        # A lock whose supplier file mirror has not landed yet is only visible in the stored stock
+        held = set(current.loc[current["LOCKED"] == "YES", "Stock #"].astype(str))
+        ids = df["Stock #"].astype(str)
+        df.loc[ids.isin(held).to_numpy(), "LOCKED"] = "YES"
+        dropped = sorted(held.difference(ids))
+        return df
+    
+    final_df = cas_update_stock(build, excel_copy=True)
+    if dropped:
+        release_stone_locks(dropped)
+    return final_df
+
+def _held_locks(stock: pd.DataFrame, supplier_name: str) -> set:
+    """Stock # of the supplier's stones that are LOCKED in the given combined stock"""
+    if not {"Stock #", "SUPPLIER", "LOCKED"}.issubset(stock.columns):
+        return set()
+    return set(stock.loc[(stock["SUPPLIER"] == supplier_name) & (stock["LOCKED"] == "YES"), "Stock #"].astype(str))
+
+def update_combined_stock(supplier_name: str, supplier_df: pd.DataFrame):
+    """Swap one supplier's rows into the combined stock instead of re-reading every supplier file"""
     try:
         if not s3:
-            return False
-            
-        df = load_stock()
-        
-        if df.empty or "Stock #" not in df.columns or "LOCKED" not in df.columns:
-            return False
-        
-        mask = (df["Stock #"] == stone_id) & (df["LOCKED"] != "YES")
-        if not mask.any():
-            return False
+            return
         
-        df.loc[mask, "LOCKED"] = "YES"
+        supplier_df = supplier_df.reindex(columns=COMBINED_STOCK_COLUMNS, fill_value="").assign(SUPPLIER=supplier_name)
+        uploaded_ids = supplier_df["Stock #"].astype(str)
+        kept: List[str] = []
+        dropped: List[str] = []
         
-        for col in df.select_dtypes(include="object"):
-            df[col] = df[col].map(safe_excel)
+        def build(current: pd.DataFrame) -> Optional[pd.DataFrame]:
+            nonlocal kept, dropped
+            if current.empty or "SUPPLIER" not in current.columns:
+                return None
+            
+            # Read locks from the frame being swapped so a lock taken mid-upload survives the retry
+            held = _held_locks(current, supplier_name)
+            kept = sorted(held.intersection(uploaded_ids))
+            # Locked stones this upload no longer lists lose their row, so their lock keys must go too
+            dropped = sorted(held.difference(uploaded_ids))
+            
+            rows = supplier_df.copy()
+            rows.loc[uploaded_ids.isin(kept).to_numpy(), "LOCKED"] = "YES"
+            
+            others = current.loc[current["SUPPLIER"] != supplier_name].reindex(columns=COMBINED_STOCK_COLUMNS, fill_value="")
+            # Stable sort keeps suppliers in the same order a full rebuild produces
+            return pd.concat([others, rows], ignore_index=True).sort_values(
+                "SUPPLIER", kind="stable", ignore_index=True
+            )
         
-        temp_path = "/tmp/locked_stock.xlsx"
-        df.to_excel(temp_path, index=False)
-        s3.upload_file(temp_path, CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY)
+        final_df = cas_update_stock(build, excel_copy=True)
+        if final_df is None:
+            rebuild_combined_stock()
+            return
         
-        stone_row = df[df["Stock #"] == stone_id].iloc[0]
-        supplier = stone_row.get("SUPPLIER", "")
+        save_stone_index(final_df)
+        if kept:
+            _set_supplier_locked(supplier_name, kept, "YES")
+        if dropped:
+            release_stone_locks(dropped)
         
-        if supplier:
-            supplier_file = f"{SUPPLIER_STOCK_FOLDER}{supplier}.xlsx"
-            try:
-                s3.download_file(CONFIG["AWS_BUCKET"], supplier_file, "/tmp/supplier_stock.xlsx")
-                supplier_df = pd.read_excel("/tmp/supplier_stock.xlsx")
-                
-                if "Stock #" in supplier_df.columns and "LOCKED" in supplier_df.columns:
-                    supplier_df.loc[supplier_df["Stock #"] == stone_id, "LOCKED"] = "YES"
-                    
-                    for col in supplier_df.select_dtypes(include="object"):
-                        supplier_df[col] = supplier_df[col].map(safe_excel)
-                    
-                    supplier_df.to_excel("/tmp/supplier_stock.xlsx", index=False)
-                    s3.upload_file("/tmp/supplier_stock.xlsx", CONFIG["AWS_BUCKET"], supplier_file)
-            except Exception as e:
-                logger.error(f"Failed to update supplier file: {e}")
+        # The supplier listing changed, so the next full rebuild must not reuse the memo
+        _COMBINED_MEMO.update(signature=None, etag=None, df=None)
         
-        for path in [temp_path, "/tmp/supplier_stock.xlsx"]:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except:
-                    pass
-        
-        logger.info(f"✅ Locked stone: {stone_id}")
-        startup_cache["stock"] = None
+        logger.info(f"✅ Updated combined stock for {supplier_name}: {len(final_df)} items")
         
+    except Exception as e:
+        logger.error(f"❌ Incremental stock update failed, rebuilding: {e}")
+        rebuild_combined_stock()
+
+def save_stone_index(df: pd.DataFrame):
+    """Persist the Stock # -> supplier file mapping used for single-file updates"""
+    try:
+        index = {
+            str(stone_id): f"{SUPPLIER_STOCK_FOLDER}{supplier}.xlsx"
+            for stone_id, supplier in zip(df["Stock #"], df["SUPPLIER"])
+        }
+        s3.put_object(
+            Bucket=AWS_BUCKET,
+            Key=STOCK_INDEX_KEY,
+            Body=to_json(index),
+            ContentType="application/json"
+        )
+    except Exception as e:
+        logger.error(f"❌ Failed to save stone index: {e}")
+
+def load_stone_index() -> Dict[str, str]:
+    """Read the Stock # -> supplier file mapping, empty if it is unavailable"""
+    try:
+        obj = s3.get_object(Bucket=AWS_BUCKET, Key=STOCK_INDEX_KEY)
+        return orjson.loads(obj["Body"].read())
+    except Exception as e:
+        logger.warning(f"⚠️ Stone index unavailable: {e}")
+        return {}
+
+def acquire_stone_lock(stone_id: str) -> bool:
+    """Create the per-stone lock key, failing if another deal already holds it"""
+    try:
+        s3.put_object(
+            Bucket=AWS_BUCKET,
+            Key=f"{STONE_LOCK_FOLDER}{stone_id}.json",
+            Body=to_json({"stone_id": stone_id, "locked_at": datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S")}),
+            ContentType="application/json",
+            IfNoneMatch="*"
+        )
         return True
-        
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in CONDITIONAL_WRITE_FAILURES:
+            return False
+        raise
+
+def release_stone_lock(stone_id: str):
+    s3.delete_object(Bucket=AWS_BUCKET, Key=f"{STONE_LOCK_FOLDER}{stone_id}.json")
+
+def release_stone_locks(stone_ids: List[str]):
+    """Delete the lock keys of several stones in one batched call"""
+    try:
+        delete_s3_keys([f"{STONE_LOCK_FOLDER}{sid}.json" for sid in stone_ids])
     except Exception as e:
-        logger.error(f"❌ Atomic lock failed for stone {stone_id}: {e}")
-        return False
+        logger.error(f"❌ Failed to release locks for {stone_ids}: {e}")
 
-def unlock_stone(stone_id: str):
-    """Unlock a stone"""
+def _set_supplier_locked(supplier: str, stone_ids: List[str], value: str):
+    """Mirror LOCKED flags into one supplier's stock file with a single read and write"""
+    key = f"{SUPPLIER_STOCK_FOLDER}{supplier}.xlsx"
     try:
-        df = load_stock()
-        if df.empty:
-            return
+        obj = s3.get_object(Bucket=AWS_BUCKET, Key=key)
+        supplier_df = _read_excel(BytesIO(obj["Body"].read()))
         
-        if "Stock #" not in df.columns or "LOCKED" not in df.columns:
+        if "Stock #" not in supplier_df.columns or "LOCKED" not in supplier_df.columns:
             return
         
-        df.loc[df["Stock #"] == stone_id, "LOCKED"] = "NO"
+        supplier_df.loc[supplier_df["Stock #"].astype(str).isin(stone_ids), "LOCKED"] = value
+        escape_formulas(supplier_df)
+        put_excel(supplier_df, key)
+    except Exception as e:
+        logger.error(f"Failed to update supplier file {key}: {e}")
+
+def _mirror_supplier_locked(df: pd.DataFrame, positions: np.ndarray, value: str):
+    """Mirror LOCKED flags for the given stock rows into their supplier files concurrently"""
+    if not len(positions) or "SUPPLIER" not in df.columns:
+        return
+    
+    groups = [
+        (supplier, ids.astype(str).tolist())
+        for supplier, ids in df.iloc[positions].groupby("SUPPLIER", observed=True, sort=False)["Stock #"]
+        if supplier
+    ]
+    list(S3_EXECUTOR.map(lambda group: _set_supplier_locked(*group, value), groups))
+
+def lock_stones(stone_ids: List[str]) -> List[str]:
+    """Lock several stones with one stock write, returning the ids actually locked"""
+    if not s3 or not stone_ids:
+        return []
+    
+    acquired = []
+    try:
+        # The conditional puts are the atomic step; the LOCKED column below just mirrors them
+        candidates = list(dict.fromkeys(stone_ids))
+        acquired = [sid for sid, ok in zip(candidates, S3_EXECUTOR.map(acquire_stone_lock, candidates)) if ok]
+        if not acquired:
+            return []
+        
+        locked, positions = [], np.array([], dtype=np.int64)
         
-        temp_path = "/tmp/all_suppliers_stock.xlsx"
-        for col in df.select_dtypes(include="object"):
-            df[col] = df[col].map(safe_excel)
+        def build(current: pd.DataFrame) -> Optional[pd.DataFrame]:
+            nonlocal locked, positions
+            locked, positions = [], np.array([], dtype=np.int64)
+            if current.empty or "Stock #" not in current.columns or "LOCKED" not in current.columns:
+                return None
+            
+            df = current.copy()
+            positions = stock_positions(df, acquired)
+            positions = positions[(df["LOCKED"].iloc[positions] != "YES").to_numpy()]
+            locked = list(dict.fromkeys(df["Stock #"].iloc[positions].astype(str)))
+            if not locked:
+                return None
+            
+            df.iloc[positions, df.columns.get_loc("LOCKED")] = "YES"
+            return df
         
-        df.to_excel(temp_path, index=False)
+        df = cas_update_stock(build)
         
-        if s3:
-            s3.upload_file(temp_path, CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY)
+        for sid in set(acquired) - set(locked):
+            release_stone_lock(sid)
+        acquired = locked
+        if df is None:
+            return []
         
-        stone_row = df[df["Stock #"] == stone_id].iloc[0]
-        supplier = stone_row.get("SUPPLIER", "")
+        _mirror_supplier_locked(df, positions, "YES")
         
-        if supplier and s3:
-            supplier_file = f"{SUPPLIER_STOCK_FOLDER}{supplier}.xlsx"
+        logger.info(f"✅ Locked {len(locked)} stone(s): {', '.join(locked)}")
+        return locked
+        
+    except Exception as e:
+        logger.error(f"❌ Failed to lock stones {stone_ids}: {e}")
+        for sid in acquired:
             try:
-                s3.download_file(CONFIG["AWS_BUCKET"], supplier_file, "/tmp/supplier_stock.xlsx")
-                supplier_df = pd.read_excel("/tmp/supplier_stock.xlsx")
-                
-                if "Stock #" in supplier_df.columns and "LOCKED" in supplier_df.columns:
-                    supplier_df.loc[supplier_df["Stock #"] == stone_id, "LOCKED"] = "NO"
-                    supplier_df.to_excel("/tmp/supplier_stock.xlsx", index=False)
-                    s3.upload_file("/tmp/supplier_stock.xlsx", CONFIG["AWS_BUCKET"], supplier_file)
-            except:
+                release_stone_lock(sid)
+            except Exception:
                 pass
+        return []
+
+def atomic_lock_stone(stone_id: str) -> bool:
+    """Atomically lock a stone to prevent race conditions"""
+    return str(stone_id) in lock_stones([str(stone_id)])
+
+def unlock_stones(stone_ids: List[str]):
+    """Unlock several stones with one stock write and one write per supplier file"""
+    if not s3 or not stone_ids:
+        return
+    
+    stone_ids = list(dict.fromkeys(str(sid) for sid in stone_ids))
+    try:
+        positions = np.array([], dtype=np.int64)
         
-        for path in [temp_path, "/tmp/supplier_stock.xlsx"]:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except:
-                    pass
+        def build(current: pd.DataFrame) -> Optional[pd.DataFrame]:
+            nonlocal positions
+            if current.empty or "Stock #" not in current.columns or "LOCKED" not in current.columns:
+                return None
+            
+            df = current.copy()
+            positions = stock_positions(df, stone_ids)
+            df.iloc[positions, df.columns.get_loc("LOCKED")] = "NO"
+            return df
+        
+        df = cas_update_stock(build)
+        if df is not None:
+            _mirror_supplier_locked(df, positions, "NO")
         
-        logger.info(f"✅ Unlocked stone: {stone_id}")
-        startup_cache["stock"] = None
+        logger.info(f"✅ Unlocked {len(stone_ids)} stone(s): {', '.join(stone_ids)}")
         
     except Exception as e:
-        logger.error(f"❌ Failed to unlock stone {stone_id}: {e}")
+        logger.error(f"❌ Failed to unlock stones {stone_ids}: {e}")
+    finally:
+        # A leftover lock key would make the stone unlockable forever
+        release_stone_locks(stone_ids)
+
+def _remove_stones_from_supplier_file(key: str, stone_ids: set) -> set:
+    """Drop stones from one supplier file, returning the ids that were there"""
+    obj = s3.get_object(Bucket=AWS_BUCKET, Key=key)
+    sdf = _read_excel(BytesIO(obj["Body"].read()))
+    
+    if "Stock #" not in sdf.columns:
+        return set()
+    
+    ids = sdf["Stock #"].astype(str)
+    hit = ids.isin(stone_ids)
+    if not hit.any():
+        return set()
+    
+    put_excel(sdf[~hit], key)
+    return set(ids[hit])
 
-def remove_stone_from_supplier_and_combined(stone_id: str):
-    """Remove stone from both supplier and combined stock"""
+def remove_stones_from_supplier_and_combined(stone_ids: List[str]):
+    """Remove several stones from the combined stock and their supplier files"""
+    if not stone_ids:
+        return
+    
+    pending = set(str(sid) for sid in stone_ids)
     try:
-        df = load_stock()
-        if not df.empty and "Stock #" in df.columns:
-            df = df[df["Stock #"] != stone_id]
-            
-            temp_path = "/tmp/all_suppliers_stock.xlsx"
-            df.to_excel(temp_path, index=False)
-            
-            if s3:
-                s3.upload_file(temp_path, CONFIG["AWS_BUCKET"], COMBINED_STOCK_KEY)
-            
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+        def build(current: pd.DataFrame) -> Optional[pd.DataFrame]:
+            if current.empty or "Stock #" not in current.columns:
+                return None
+            return current[~current["Stock #"].astype(str).isin(pending)].reset_index(drop=True)
+        
+        df = cas_update_stock(build, excel_copy=True) if s3 else None
         
         if s3:
-            objs = s3.list_objects_v2(
-                Bucket=CONFIG["AWS_BUCKET"],
-                Prefix=SUPPLIER_STOCK_FOLDER
-            )
+            index = load_stone_index()
+            by_file = defaultdict(set)
+            for sid in pending:
+                if sid in index:
+                    by_file[index[sid]].add(sid)
             
-            for obj in objs.get("Contents", []):
-                key = obj["Key"]
-                if not key.endswith(".xlsx"):
-                    continue
-                
-                local_path = "/tmp/tmp_supplier.xlsx"
-                s3.download_file(CONFIG["AWS_BUCKET"], key, local_path)
-                sdf = pd.read_excel(local_path)
-                
-                if "Stock #" in sdf.columns and stone_id in sdf["Stock #"].values:
-                    sdf = sdf[sdf["Stock #"] != stone_id]
-                    sdf.to_excel(local_path, index=False)
-                    s3.upload_file(local_path, CONFIG["AWS_BUCKET"], key)
-                    break
-        
-        logger.info(f"✅ Removed stone {stone_id} from all stock files")
-        startup_cache["stock"] = None
+            for key, ids in by_file.items():
+                pending -= _remove_stones_from_supplier_file(key, ids)
+            
+            if pending:
+                # Index missing or stale, fall back to scanning supplier files
+                for obj in iter_s3_objects(SUPPLIER_STOCK_FOLDER, ".xlsx"):
+                    pending -= _remove_stones_from_supplier_file(obj["Key"], pending)
+                    if not pending:
+                        break
+        
+        logger.info(f"✅ Removed {len(stone_ids)} stone(s) from all stock files")
+        if df is not None and df.empty:
+            invalidate_stock_cache()
+        
+        # Sold stones may be re-uploaded under the same Stock #, so free their lock keys
+        if s3:
+            release_stone_locks(list(dict.fromkeys(str(sid) for sid in stone_ids)))
         
     except Exception as e:
-        logger.error(f"❌ Failed to remove stone {stone_id}: {e}")
+        logger.error(f"❌ Failed to remove stones {stone_ids}: {e}")
 
 # ============= DEAL MANAGEMENT =============
-def log_deal_history(deal: Dict[str, Any]):
-    """Log deal to history file"""
+# Columns of the bulk deal template clients fill in and upload
+BULK_DEAL_COLUMNS = ["Stock #", "Offer Price ($/ct)"]
+
+# Deal record field -> column header used in history rows and exports
+DEAL_EXPORT_COLUMNS = {
+    "deal_id": "Deal ID",
+    "stone_id": "Stone ID",
+    "supplier_username": "Supplier",
+    "client_username": "Client",
+    "actual_stock_price": "Actual Price",
+    "client_offer_price": "Offer Price",
+    "supplier_action": "Supplier Action",
+    "admin_action": "Admin Action",
+    "final_status": "Final Status",
+    "created_at": "Created At",
+}
+DEAL_COLUMNS = list(DEAL_EXPORT_COLUMNS)
+
+def log_deal_history(deals: List[Dict[str, Any]]):
+    """Append deals to the history dataset as one Parquet part per year/month partition"""
     try:
-        if not s3:
+        if not s3 or not deals:
             return
-            
-        local_path = "/tmp/deal_history.xlsx"
         
-        try:
-            s3.download_file(CONFIG["AWS_BUCKET"], DEAL_HISTORY_KEY, local_path)
-            df = pd.read_excel(local_path)
-        except:
-            df = pd.DataFrame(columns=[
-                "Deal ID", "Stone ID", "Supplier", "Client", "Actual Price",
-                "Offer Price", "Supplier Action", "Admin Action", "Final Status", "Created At"
-            ])
-        
-        new_row = pd.DataFrame([{
-            "Deal ID": deal.get("deal_id"),
-            "Stone ID": deal.get("stone_id"),
-            "Supplier": deal.get("supplier_username"),
-            "Client": deal.get("client_username"),
-            "Actual Price": deal.get("actual_stock_price"),
-            "Offer Price": deal.get("client_offer_price"),
-            "Supplier Action": deal.get("supplier_action"),
-            "Admin Action": deal.get("admin_action"),
-            "Final Status": deal.get("final_status"),
-            "Created At": deal.get("created_at"),
-        }])
-        
-        df = pd.concat([df, new_row], ignore_index=True)
-        df.to_excel(local_path, index=False)
-        s3.upload_file(local_path, CONFIG["AWS_BUCKET"], DEAL_HISTORY_KEY)
-        
-        logger.info(f"✅ Logged deal to history: {deal.get('deal_id')}")
+        history = pd.DataFrame(deals).reindex(columns=DEAL_COLUMNS).rename(columns=DEAL_EXPORT_COLUMNS)
+        created = pd.to_datetime(history["Created At"], errors="coerce").fillna(pd.Timestamp(datetime.now(IST).replace(tzinfo=None)))
+        
+        for (year, month), part in history.groupby([created.dt.year, created.dt.month], sort=False):
+            buffer = BytesIO()
+            _parquet_safe(part).to_parquet(buffer, engine="pyarrow", compression="snappy", index=False)
+            s3.put_object(
+                Bucket=AWS_BUCKET,
+                Key=f"{DEAL_HISTORY_FOLDER}year={year}/month={month:02d}/part-{uuid.uuid4().hex}.parquet",
+                Body=buffer.getvalue()
+            )
+        
+        logger.info(f"✅ Logged {len(deals)} deal(s) to history")
         
     except Exception as e:
         logger.error(f"❌ Failed to log deal history: {e}")
-    finally:
-        if os.path.exists(local_path):
+
+# S3 key -> (ETag, deal) so unchanged deals are not downloaded again
+_DEAL_CACHE: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+
+def load_deals() -> List[Dict[str, Any]]:
+    """Load all deals (deals/{supplier}/ and legacy flat keys), fetching only new or changed files in parallel"""
+    objs = list(iter_s3_objects(DEALS_FOLDER, ".json"))
+    misses = [obj for obj in objs if _DEAL_CACHE.get(obj["Key"], (None,))[0] != obj["ETag"]]
+    
+    bodies = fetch_s3_bodies([obj["Key"] for obj in misses])
+    for obj, body in zip(misses, bodies):
+        if body is None:
+            continue
+        try:
+            _DEAL_CACHE[obj["Key"]] = (obj["ETag"], orjson.loads(body))
+        except Exception as e:
+            logger.error(f"Failed to parse deal {obj['Key']}: {e}")
+    
+    live_keys = {obj["Key"] for obj in objs}
+    for key in list(_DEAL_CACHE):
+        if key not in live_keys:
+            _DEAL_CACHE.pop(key, None)
+    
+    return [_DEAL_CACHE[obj["Key"]][1] for obj in objs if obj["Key"] in _DEAL_CACHE]
+
+# Latest (etag, frame) of the deals index, swapped as one tuple so readers never mix two loads
+_DEALS_INDEX: Dict[str, Optional[Tuple[str, pd.DataFrame]]] = {"snapshot": None}
+DEALS_INDEX_RETRIES = 10
+
+def _deals_frame(deals: List[Dict[str, Any]]) -> pd.DataFrame:
+    return pd.DataFrame(deals).reindex(columns=DEAL_COLUMNS)
+
+def _save_deals_index(df: pd.DataFrame, **conditions):
+    """Write the deals index; conditions (IfMatch / IfNoneMatch) make it a compare-and-swap"""
+    buffer = BytesIO()
+    _parquet_safe(df).to_parquet(buffer, engine="pyarrow", compression="snappy", index=False)
+    response = s3.put_object(Bucket=AWS_BUCKET, Key=DEALS_INDEX_KEY, Body=buffer.getvalue(), **conditions)
+    _DEALS_INDEX["snapshot"] = (response["ETag"], df)
+
+def _load_deals_index_snapshot() -> Tuple[pd.DataFrame, Optional[str]]:
+    """Return the deals index with the ETag it was read at (None if the index does not exist)"""
+    snapshot = _DEALS_INDEX["snapshot"]
+    kwargs = {"IfNoneMatch": snapshot[0]} if snapshot is not None else {}
+    try:
+        obj = s3.get_object(Bucket=AWS_BUCKET, Key=DEALS_INDEX_KEY, **kwargs)
+    except ClientError as e:
+        code = e.response.get("Error", {}).get("Code")
+        if code == "304":
+            return snapshot[1], snapshot[0]
+        if code not in ("404", "NoSuchKey", "NotFound"):
+            raise
+        return _deals_frame([]), None
+    
+    df = pd.read_parquet(BytesIO(obj["Body"].read())).reindex(columns=DEAL_COLUMNS)
+    _DEALS_INDEX["snapshot"] = (obj["ETag"], df)
+    return df, obj["ETag"]
+
+def load_deals_index() -> pd.DataFrame:
+    """Load every deal from the single Parquet index, building it from deal files if missing"""
+    df, etag = _load_deals_index_snapshot()
+    if etag is not None:
+        return df
+    
+    logger.info("ℹ️ No deals index yet, building from deal files")
+    df = _deals_frame(load_deals())
+    try:
+        _save_deals_index(df, IfNoneMatch="*")
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in CONDITIONAL_WRITE_FAILURES:
+            raise
+        # Another writer created the index first; theirs already covers the deal files
+        df, _ = _load_deals_index_snapshot()
+    return df
+
+def append_to_deals_index(deals: List[Dict[str, Any]]):
+    """Append new deal records to the Parquet index, retrying when a concurrent writer got there first"""
+    try:
+        for attempt in range(DEALS_INDEX_RETRIES):
+            current, etag = _load_deals_index_snapshot()
+            if etag is None:
+                # Seed a missing index from the deal files, which already include these deals
+                current = _deals_frame(load_deals())
+            df = pd.concat([current, _deals_frame(deals)], ignore_index=True)
+            df = df.drop_duplicates("deal_id", keep="last").reset_index(drop=True)
+            
+            conditions = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
             try:
-                os.remove(local_path)
-            except:
-                pass
+                _save_deals_index(df, **conditions)
+                return
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in CONDITIONAL_WRITE_FAILURES:
+                    raise
+                logger.info(f"ℹ️ Deals index changed while appending, retrying ({attempt + 1}/{DEALS_INDEX_RETRIES})")
+                # Spread out retries so a burst of writers does not collide in lockstep
+                time.sleep(random.uniform(0, 0.05 * (attempt + 1)))
+        
+        raise RuntimeError(f"Deals index kept changing after {DEALS_INDEX_RETRIES} attempts")
+    except Exception as e:
+        logger.error(f"❌ Failed to update deals index: {e}")
+
+def new_deal(stone: Dict[str, Any], client_username: str, offer_price: float) -> Dict[str, Any]:
+    """Build an open deal record for a client offer on a stock row"""
+    return {
+        "deal_id": f"DEAL-{uuid.uuid4().hex[:10].upper()}",
+        "stone_id": str(stone.get("Stock #")),
+        "supplier_username": str(stone.get("SUPPLIER") or "").removeprefix("supplier_"),
+        "client_username": client_username,
+        "actual_stock_price": float(stone.get("Price Per Carat") or 0),
+        "client_offer_price": offer_price,
+        "supplier_action": "PENDING",
+        "admin_action": "PENDING",
+        "final_status": "OPEN",
+        "created_at": datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+def store_deals(deals: List[Dict[str, Any]]):
+    """Write new deal files, then add them to the deals index and history"""
+    if not s3 or not deals:
+        return
+    
+    def put_deal(deal: Dict[str, Any]) -> Tuple[str, str]:
+        # Group deal files per supplier so one supplier's deals share a listing prefix
+        deal_key = f"{DEALS_FOLDER}{deal['supplier_username'] or '_unknown'}/{deal['deal_id']}.json"
+        response = s3.put_object(
+            Bucket=AWS_BUCKET,
+            Key=deal_key,
+            Body=to_json(deal),
+            ContentType="application/json"
+        )
+        return deal_key, response["ETag"]
+    
+    for deal, (deal_key, etag) in zip(deals, S3_EXECUTOR.map(put_deal, deals)):
+        _DEAL_CACHE[deal_key] = (etag, deal)
+    
+    append_to_deals_index(deals)
+    log_deal_history(deals)
+
+# ============= ASYNC HELPERS =============
+# Bounds how many blocking S3/pandas calls run in worker threads at once
+BLOCKING_SEMAPHORE = asyncio.Semaphore(16)
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call in a worker thread so the event loop keeps serving updates"""
+    async with BLOCKING_SEMAPHORE:
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+async def _aload_stock() -> pd.DataFrame:
+    return await run_blocking(load_stock)
+
+async def _aload_accounts(copy=True) -> pd.DataFrame:
+    return await run_blocking(load_accounts, copy=copy)
 
 # ============= BACKGROUND TASKS =============
 async def session_cleanup_loop():
     """Background task to clean up expired sessions"""
     while True:
         try:
-            cleanup_sessions()
+            await asyncio.to_thread(cleanup_sessions)
         except Exception as e:
             logger.error(f"❌ Session cleanup error: {e}")
         await asyncio.sleep(600)
 
+async def session_checkpoint_loop():
+    """Background task to persist session activity times at most once a minute, only after activity"""
+    while True:
+        await _sessions_dirty.wait()
+        # Every update in the next minute lands in the same checkpoint write
+        await asyncio.sleep(60)
+        _sessions_dirty.clear()
+        try:
+            await asyncio.to_thread(save_sessions)
+        except Exception as e:
+            logger.error(f"❌ Session checkpoint error: {e}")
+
+async def activity_rollup_loop():
+    """Background task folding finished days of activity logs into Parquet once an hour"""
+    while True:
+        await asyncio.sleep(3600)
+        try:
+            if s3:
+                await asyncio.to_thread(rollup_activity_logs)
+        except Exception as e:
+            logger.error(f"❌ Activity rollup error: {e}")
+
 async def user_state_cleanup_loop():
     """Background task to clean up old user states"""
     while True:
@@ -907,7 +1996,7 @@ async def user_state_cleanup_loop():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """FastAPI lifespan manager for startup/shutdown"""
-    global BOT_STARTED
+    global BOT_STARTED, LOG_QUEUE, _LOG_LOOP
     
     # Startup
     logger.info("🤖 Diamond Trading Bot starting up...")
@@ -915,6 +2004,8 @@ async def lifespan(app: FastAPI):
     try:
         load_sessions()
         preload_data()
+        sample_template_bytes()
+        api_template_bytes()
         
         # Set webhook if WEBHOOK_URL is provided
         webhook_url = CONFIG["WEBHOOK_URL"]
@@ -949,7 +2040,13 @@ async def lifespan(app: FastAPI):
     
     # Start background tasks
     asyncio.create_task(session_cleanup_loop())
+    asyncio.create_task(session_checkpoint_loop())
     asyncio.create_task(user_state_cleanup_loop())
+    asyncio.create_task(activity_rollup_loop())
+    
+    LOG_QUEUE = asyncio.Queue()
+    _LOG_LOOP = asyncio.get_running_loop()
+    log_worker = asyncio.create_task(activity_log_worker())
     
     logger.info("✅ Bot startup complete")
     
@@ -966,12 +2063,25 @@ async def lifespan(app: FastAPI):
     
     save_sessions()
     
+    log_worker.cancel()
+    try:
+        await log_worker
+    except asyncio.CancelledError:
+        pass
+    pending_logs = _drain_log_queue()
+    LOG_QUEUE = None
+    if pending_logs:
+        _write_activity_batch(pending_logs)
+        logger.info(f"✅ Flushed {len(pending_logs)} queued activity logs")
+    
     try:
         await bot.session.close()
         logger.info("✅ Bot session closed")
     except Exception as e:
         logger.error(f"❌ Error closing bot session: {e}")
     
+    S3_EXECUTOR.shutdown(wait=True)
+    
     BOT_STARTED = False
     logger.info("✅ Bot shutdown complete")
 
@@ -980,7 +2090,7 @@ def preload_data():
     """Preload data on startup for faster response"""
     logger.info("🔄 Preloading data on startup...")
     try:
-        load_accounts()
+        load_accounts(copy=False)
         logger.info("✅ Accounts preloaded")
         
         load_stock()
@@ -993,9 +2103,9 @@ def preload_data():
 app = FastAPI(title="Diamond Trading Bot", lifespan=lifespan)
 
 # ============= HEALTH CHECK ENDPOINTS =============
-@app.get("/")
+@app.get("/", response_class=ORJSONResponse)
 async def root():
-    return {
+    return ORJSONResponse({
         "status": "online",
         "service": "Diamond Trading Bot",
         "version": "1.0",
@@ -1004,9 +2114,9 @@ async def root():
         "active_sessions": len(logged_in_users),
         "aws_connected": s3 is not None,
         "bucket": CONFIG["AWS_BUCKET"]
-    }
+    })
 
-@app.get("/health")
+@app.get("/health", response_class=ORJSONResponse)
 async def health_check():
     """Health check endpoint"""
     status = "healthy" if BOT_STARTED else "starting"
@@ -1016,12 +2126,12 @@ async def health_check():
     
     if s3:
         try:
-            s3.head_bucket(Bucket=CONFIG["AWS_BUCKET"])
+            await run_blocking(s3.head_bucket, Bucket=AWS_BUCKET)
             bucket_accessible = True
         except:
             pass
     
-    return {
+    return ORJSONResponse({
         "status": status,
         "bot": "running" if BOT_STARTED else "stopped",
         "webhook": "set" if CONFIG["WEBHOOK_URL"] else "not set",
@@ -1029,7 +2139,7 @@ async def health_check():
         "bucket_accessible": bucket_accessible,
         "active_users": len(logged_in_users),
         "timestamp": datetime.now().isoformat()
-    }
+    })
 
 @app.get("/ping")
 async def ping():
@@ -1051,7 +2161,7 @@ async def keep_alive():
         "timestamp": datetime.now().isoformat(),
         "bot_status": "running" if BOT_STARTED else "starting",
         "active_sessions": len(logged_in_users),
-        "cache_hit": startup_cache["accounts"] is not None
+        "cache_hit": _ACCOUNTS_CACHE["df"] is not None
     }
 
 @app.get("/status")
@@ -1081,14 +2191,14 @@ async def status_check():
             "python_version": "3.11.0",
             "port": CONFIG.get("PORT"),
             "session_timeout": CONFIG.get("SESSION_TIMEOUT"),
-            "cache_loaded": startup_cache["accounts"] is not None,
+            "cache_loaded": _ACCOUNTS_CACHE["df"] is not None,
             "cache_age_seconds": time.time() - startup_cache["last_loaded"] if startup_cache["last_loaded"] > 0 else 0
         }
     }
     
     if s3:
         try:
-            s3.list_objects_v2(Bucket=CONFIG["AWS_BUCKET"], MaxKeys=1)
+            await run_blocking(s3.list_objects_v2, Bucket=AWS_BUCKET, MaxKeys=1)
             status["aws"]["bucket_accessible"] = True
         except Exception as e:
             status["aws"]["bucket_accessible"] = False
@@ -1096,13 +2206,15 @@ async def status_check():
     
     return status
 
-@app.get("/sessions")
-async def get_sessions():
-    """Admin endpoint to view active sessions"""
-    return {
+@app.get("/sessions", response_class=ORJSONResponse)
+async def get_sessions(full: bool = False, limit: int = 200):
+    """Admin endpoint to view active sessions (Telegram ids only unless full=true)"""
+    # ORJSONResponse skips jsonable_encoder's walk over every session dict
+    sessions = logged_in_users if full else list(itertools.islice(logged_in_users, max(limit, 0)))
+    return ORJSONResponse({
         "active_sessions": len(logged_in_users),
-        "sessions": logged_in_users
-    }
+        "sessions": sessions
+    })
 
 @app.get("/debug")
 async def debug_info():
@@ -1114,7 +2226,7 @@ async def debug_info():
         
         if s3:
             try:
-                s3.head_bucket(Bucket=CONFIG["AWS_BUCKET"])
+                await run_blocking(s3.head_bucket, Bucket=AWS_BUCKET)
                 bucket_accessible = True
             except Exception as e:
                 bucket_accessible = False
@@ -1138,7 +2250,7 @@ async def debug_info():
                 "error": s3_error
             },
             "cache": {
-                "accounts_loaded": startup_cache["accounts"] is not None,
+                "accounts_loaded": _ACCOUNTS_CACHE["df"] is not None,
                 "stock_loaded": startup_cache["stock"] is not None,
                 "last_loaded": startup_cache["last_loaded"],
                 "age_seconds": time.time() - startup_cache["last_loaded"] if startup_cache["last_loaded"] > 0 else 0
@@ -1186,11 +2298,11 @@ async def api_upload_excel(
             )
         
         contents = await file.read()
-        df = pd.read_excel(BytesIO(contents))
-        
         supplier_name = f"supplier_{username.lower()}"
+        df = await run_blocking(read_supplier_excel, BytesIO(contents), supplier_name)
+        
         validator = DiamondExcelValidator()
-        success, cleaned_df, errors, warnings = validator.validate_and_parse(df, supplier_name)
+        success, cleaned_df, errors, warnings = await run_blocking(validator.validate_and_parse, df, supplier_name)
         
         if not success:
             return JSONResponse(
@@ -1204,14 +2316,13 @@ async def api_upload_excel(
             )
         
         supplier_file = f"{SUPPLIER_STOCK_FOLDER}{supplier_name}.xlsx"
-        temp_path = f"/tmp/{supplier_name}.xlsx"
-        cleaned_df.to_excel(temp_path, index=False)
         
         if s3:
-            s3.upload_file(temp_path, CONFIG["AWS_BUCKET"], supplier_file)
+            await run_blocking(put_excel, cleaned_df, supplier_file)
             logger.info(f"✅ Uploaded {len(cleaned_df)} diamonds for supplier {username}")
         
-        rebuild_combined_stock()
+        await run_blocking(update_combined_stock, supplier_name, cleaned_df)
+        await run_blocking(save_supplier_schema, supplier_name, df)
         
         total_stones = len(cleaned_df)
         total_carats = cleaned_df["Weight"].sum() if "Weight" in cleaned_df.columns else 0
@@ -1224,9 +2335,6 @@ async def api_upload_excel(
             "warnings": warnings
         })
         
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-        
         return JSONResponse(
             status_code=200,
             content={
@@ -1249,86 +2357,89 @@ async def api_upload_excel(
             content={"success": False, "message": f"Server error: {str(e)}"}
         )
 
+@functools.lru_cache(maxsize=1)
+def api_template_bytes() -> bytes:
+    """Build the API stock template once and reuse its bytes"""
+    sample_data = {
+        "Stock #": ["DIA001", "DIA002", "DIA003"],
+        "Shape": ["Round", "Princess", "Oval"],
+        "Weight": [1.20, 0.90, 1.50],
+        "Color": ["D", "F", "G"],
+        "Clarity": ["IF", "VVS1", "VS1"],
+        "Price Per Carat": [12000, 9500, 7500],
+        "Lab": ["GIA", "IGI", "HRD"],
+        "Report #": ["1234567890", "2345678901", "3456789012"],
+        "Diamond Type": ["Natural", "Natural", "Lab Grown"],
+        "Description": ["Eye clean round", "Excellent princess", "Nice oval"],
+        
+        "CUT": ["EX", "VG", ""],
+        "Polish": ["EX", "", "VG"],
+        "Symmetry": ["EX", "VG", ""]
+    }
+    
+    df = pd.DataFrame(sample_data)
+    
+    buffer = BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name='Sample Stock', index=False)
+        
+        instructions_data = {
+            "Column Name": DiamondExcelValidator.ALL_COLUMNS,
+            "Required?": ["REQUIRED"] * len(DiamondExcelValidator.REQUIRED_COLUMNS) + 
+                         ["OPTIONAL"] * len(DiamondExcelValidator.OPTIONAL_COLUMNS),
+            "Description": [
+                "Unique identifier for each diamond",
+                "Shape of the diamond (Round, Princess, Oval, etc.)",
+                "Weight in carats (e.g., 1.20)",
+                "Color grade (D, E, F, etc.)",
+                "Clarity grade (IF, VVS1, VS2, etc.)",
+                "Price per carat in USD",
+                "Certification lab (GIA, IGI, HRD, etc.)",
+                "Certificate/report number",
+                "Type of diamond (Natural, Lab Grown, etc.)",
+                "Description or comments about the diamond",
+                "Cut grade (EX, VG, G, F, P) - CAN BE BLANK",
+                "Polish grade (EX, VG, G, F, P) - CAN BE BLANK",
+                "Symmetry grade (EX, VG, G, F, P) - CAN BE BLANK"
+            ],
+            "Example": [
+                "DIA001, STK100, 12345",
+                "Round, Princess, Oval",
+                "1.20, 0.90, 1.50",
+                "D, F, G",
+                "IF, VVS1, VS2",
+                "12000, 9500, 7500",
+                "GIA, IGI, HRD",
+                "1234567890, G12345",
+                "Natural, Lab Grown",
+                "Eye clean, No fluorescence",
+                "EX, VG, G",
+                "EX, VG, G",
+                "EX, VG, G"
+            ]
+        }
+        
+        instructions_df = pd.DataFrame(instructions_data)
+        instructions_df.to_excel(writer, sheet_name='Instructions', index=False)
+        
+        for column in instructions_df:
+            column_length = max(
+                instructions_df[column].astype(str).map(len).max(),
+                len(str(column))
+            )
+            col_idx = instructions_df.columns.get_loc(column)
+            writer.sheets['Instructions'].column_dimensions[chr(65 + col_idx)].width = column_length + 2
+    
+    return buffer.getvalue()
+
 @app.get("/api/download-template")
 async def api_download_template():
     """Download sample Excel template"""
     try:
-        sample_data = {
-            "Stock #": ["DIA001", "DIA002", "DIA003"],
-            "Shape": ["Round", "Princess", "Oval"],
-            "Weight": [1.20, 0.90, 1.50],
-            "Color": ["D", "F", "G"],
-            "Clarity": ["IF", "VVS1", "VS1"],
-            "Price Per Carat": [12000, 9500, 7500],
-            "Lab": ["GIA", "IGI", "HRD"],
-            "Report #": ["1234567890", "2345678901", "3456789012"],
-            "Diamond Type": ["Natural", "Natural", "Lab Grown"],
-            "Description": ["Eye clean round", "Excellent princess", "Nice oval"],
-            
-            "CUT": ["EX", "VG", ""],
-            "Polish": ["EX", "", "VG"],
-            "Symmetry": ["EX", "VG", ""]
-        }
-        
-        df = pd.DataFrame(sample_data)
-        
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Sample Stock', index=False)
-            
-            instructions_data = {
-                "Column Name": DiamondExcelValidator.ALL_COLUMNS,
-                "Required?": ["REQUIRED"] * len(DiamondExcelValidator.REQUIRED_COLUMNS) + 
-                             ["OPTIONAL"] * len(DiamondExcelValidator.OPTIONAL_COLUMNS),
-                "Description": [
-                    "Unique identifier for each diamond",
-                    "Shape of the diamond (Round, Princess, Oval, etc.)",
-                    "Weight in carats (e.g., 1.20)",
-                    "Color grade (D, E, F, etc.)",
-                    "Clarity grade (IF, VVS1, VS2, etc.)",
-                    "Price per carat in USD",
-                    "Certification lab (GIA, IGI, HRD, etc.)",
-                    "Certificate/report number",
-                    "Type of diamond (Natural, Lab Grown, etc.)",
-                    "Description or comments about the diamond",
-                    "Cut grade (EX, VG, G, F, P) - CAN BE BLANK",
-                    "Polish grade (EX, VG, G, F, P) - CAN BE BLANK",
-                    "Symmetry grade (EX, VG, G, F, P) - CAN BE BLANK"
-                ],
-                "Example": [
-                    "DIA001, STK100, 12345",
-                    "Round, Princess, Oval",
-                    "1.20, 0.90, 1.50",
-                    "D, F, G",
-                    "IF, VVS1, VS2",
-                    "12000, 9500, 7500",
-                    "GIA, IGI, HRD",
-                    "1234567890, G12345",
-                    "Natural, Lab Grown",
-                    "Eye clean, No fluorescence",
-                    "EX, VG, G",
-                    "EX, VG, G",
-                    "EX, VG, G"
-                ]
-            }
-            
-            instructions_df = pd.DataFrame(instructions_data)
-            instructions_df.to_excel(writer, sheet_name='Instructions', index=False)
-            
-            for column in instructions_df:
-                column_length = max(
-                    instructions_df[column].astype(str).map(len).max(),
-                    len(str(column))
-                )
-                col_idx = instructions_df.columns.get_loc(column)
-                writer.sheets['Instructions'].column_dimensions[chr(65 + col_idx)].width = column_length + 2
-        
-        buffer.seek(0)
-        
-        return FileResponse(
-            path=buffer,
+        return Response(
+            content=api_template_bytes(),
             media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            filename='diamond_stock_template.xlsx'
+            headers={"Content-Disposition": 'attachment; filename="diamond_stock_template.xlsx"'}
         )
         
     except Exception as e:
@@ -1343,7 +2454,7 @@ async def telegram_webhook(request: Request):
     """Handle Telegram webhook updates"""
     try:
         update_data = await request.json()
-        logger.info(f"📨 Received webhook update type: {update_data.get('update_id')}")
+        logger.debug("📨 Received webhook update %s", update_data.get("update_id"))
         
         telegram_update = types.Update(**update_data)
         await dp.feed_update(bot=bot, update=telegram_update)
@@ -1395,12 +2506,14 @@ async def test_bot():
         return {"status": "error", "error": str(e)}
 
 # ============= DOCUMENT HANDLER =============
+# Uploads larger than this are spooled to disk instead of held in memory while parsing
+DOCUMENT_SPOOL_BYTES = 1024 * 1024
+
 @dp.message(F.document)
-async def handle_document(message: types.Message):
+async def handle_document(message: types.Message, user: Optional[Dict[str, Any]] = None):
     """Handle document uploads (Excel files)"""
     try:
         uid = message.from_user.id
-        user = get_logged_user(uid)
         
         if not user:
             await message.reply("🔒 Please login first.")
@@ -1420,34 +2533,37 @@ async def handle_document(message: types.Message):
         processing_msg = await message.reply("🔄 Processing your Excel file...")
         
         file = await bot.get_file(message.document.file_id)
-        temp_path = f"/tmp/{uid}_{int(time.time())}_{file_name}"
-        await bot.download_file(file.file_path, temp_path)
+        
+        user_role = user["ROLE"]
+        supplier_key = user.get("SUPPLIER_KEY") if user_role == "supplier" else None
+        bulk_deal = user_role == "client" and user_state.get(uid, {}).get("step") == "bulk_deal_excel"
         
         try:
-            df = pd.read_excel(temp_path)
+            # Stream the download in chunks; small workbooks stay in memory, larger ones spill to an anonymous temp file
+            with tempfile.SpooledTemporaryFile(max_size=DOCUMENT_SPOOL_BYTES) as payload:
+                await bot.download_file(file.file_path, destination=payload)
+                if bulk_deal:
+                    # Only the two template columns are used; read_excel raises ValueError if either is missing
+                    df = await run_blocking(_read_excel, payload, usecols=BULK_DEAL_COLUMNS, dtype={"Stock #": str})
+                else:
+                    df = await run_blocking(read_supplier_excel, payload, supplier_key)
         except Exception as e:
-            await processing_msg.edit_text(f"❌ Error reading Excel file: {str(e)}")
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            if bulk_deal and isinstance(e, ValueError):
+                await processing_msg.edit_text("❌ File must keep the 'Stock #' and 'Offer Price ($/ct)' columns from the template.")
+            else:
+                await processing_msg.edit_text(f"❌ Error reading Excel file: {str(e)}")
             return
         
-        user_role = user["ROLE"]
-        
         if user_role == "supplier":
-            await handle_supplier_stock_upload(message, user, df, temp_path, processing_msg)
+            await handle_supplier_stock_upload(message, user, df, processing_msg)
+        elif bulk_deal:
+            await handle_bulk_deal_upload(message, user, df, processing_msg)
         else:
             await processing_msg.edit_text("❌ Only suppliers can upload stock.")
         
     except Exception as e:
         logger.error(f"❌ Error in handle_document: {e}", exc_info=True)
         await message.reply(f"❌ Error processing file: {str(e)}")
-        
-    finally:
-        if 'temp_path' in locals() and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
 
 # ============= COMMAND HANDLERS =============
 @dp.message(Command("start"))
@@ -1504,10 +2620,6 @@ async def create_account(message: types.Message):
     try:
         uid = message.from_user.id
         
-        if is_rate_limited(uid):
-            await message.reply("⏳ Please wait before creating another account.")
-            return
-        
         user_state[uid] = {
             "step": "create_username",
             "last_updated": time.time()
@@ -1522,16 +2634,11 @@ async def create_account(message: types.Message):
         logger.error(f"❌ Error in create_account handler: {e}")
 
 @dp.message(Command("login"))
-async def login_command(message: types.Message):
+async def login_command(message: types.Message, user: Optional[Dict[str, Any]] = None):
     """Start login process"""
     try:
         uid = message.from_user.id
         
-        if is_rate_limited(uid):
-            await message.reply("⏳ Please wait before trying to login again.")
-            return
-        
-        user = get_logged_user(uid)
         if user:
             await message.reply(
                 f"ℹ️ You're already logged in as {user['USERNAME']}.\n"
@@ -1545,16 +2652,15 @@ async def login_command(message: types.Message):
         }
         
         await message.reply("👤 Enter your username:")
-        logger.info(f"✅ Login started for user {uid}")
+        logger.debug("✅ Login started for user %s", uid)
     except Exception as e:
         logger.error(f"❌ Error in login_command handler: {e}")
 
 @dp.message(Command("logout"))
-async def logout_command(message: types.Message):
+async def logout_command(message: types.Message, user: Optional[Dict[str, Any]] = None):
     """Handle /logout command"""
     try:
         uid = message.from_user.id
-        user = get_logged_user(uid)
         
         if not user:
             await message.reply("ℹ️ You are not logged in.")
@@ -1562,9 +2668,9 @@ async def logout_command(message: types.Message):
         
         log_activity(user, "LOGOUT")
         
-        logged_in_users.pop(uid, None)
+        drop_session(uid)
         user_state.pop(uid, None)
-        save_sessions()
+        await run_blocking(delete_session, uid)
         
         await message.reply(
             "✅ Successfully logged out.\n"
@@ -1595,10 +2701,9 @@ async def fix_state_command(message: types.Message):
         
         user_rate_limit.pop(uid, None)
         
-        global startup_cache
-        startup_cache["accounts"] = None
-        startup_cache["stock"] = None
-        startup_cache["last_loaded"] = 0
+        _ACCOUNTS_CACHE["etag"] = None
+        _ACCOUNTS_CACHE["df"] = None
+        invalidate_stock_cache()
         
         await message.reply(
             "🔄 State cleared and cache reset.\n"
@@ -1611,11 +2716,10 @@ async def fix_state_command(message: types.Message):
         await message.reply("❌ Could not fix state.")
 
 @dp.message(Command("upload"))
-async def upload_command(message: types.Message):
+async def upload_command(message: types.Message, user: Optional[Dict[str, Any]] = None):
     """Force enable upload mode for suppliers"""
     try:
         uid = message.from_user.id
-        user = get_logged_user(uid)
         
         if not user:
             await message.reply("🔒 Please login first.")
@@ -1641,16 +2745,18 @@ async def upload_command(message: types.Message):
         logger.error(f"❌ Upload command error: {e}")
         await message.reply("❌ Error enabling upload mode.")
 
+# Sessions can carry non-string keys, which orjson only accepts with OPT_NON_STR_KEYS
+MYSTATE_JSON_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+
 @dp.message(Command("mystate"))
-async def show_my_state(message: types.Message):
+async def show_my_state(message: types.Message, user: Optional[Dict[str, Any]] = None):
     """Show current user state"""
     try:
         uid = message.from_user.id
         state = user_state.get(uid)
-        user = get_logged_user(uid)
         
-        state_info = json.dumps(state, default=str, indent=2) if state else "No state"
-        user_info = json.dumps(user, default=str, indent=2) if user else "Not logged in"
+        state_info = orjson.dumps(state, default=str, option=MYSTATE_JSON_OPTIONS).decode() if state else "No state"
+        user_info = orjson.dumps(user, default=str, option=MYSTATE_JSON_OPTIONS).decode() if user else "Not logged in"
         
         await message.reply(
             f"👤 **Your State:**\n"
@@ -1665,8 +2771,8 @@ async def show_my_state(message: types.Message):
 async def test_data_loading(message: types.Message):
     """Test data loading"""
     try:
-        accounts_df = load_accounts()
-        stock_df = load_stock()
+        accounts_df = await _aload_accounts(copy=False)
+        stock_df = await _aload_stock()
         
         await message.reply(
             f"📊 **Data Load Test:**\n\n"
@@ -1679,21 +2785,13 @@ async def test_data_loading(message: types.Message):
 
 # ============= STATE HANDLER =============
 @dp.message()
-async def handle_all_messages(message: types.Message):
+async def handle_all_messages(message: types.Message, user: Optional[Dict[str, Any]] = None):
     """Main message handler for state-based flows"""
     try:
         uid = message.from_user.id
         text = message.text.strip() if message.text else ""
         
-        logger.info(f"📩 Received message from {uid}: {text}")
-        
-        if is_rate_limited(uid):
-            await message.reply("⏳ Too many messages. Please slow down.")
-            return
-        
-        user = get_logged_user(uid)
-        if user:
-            touch_session(uid)
+        logger.debug("📩 Received message from %s", uid)
         
         state = user_state.get(uid)
         if state:
@@ -1706,8 +2804,17 @@ async def handle_all_messages(message: types.Message):
                     await message.reply("❌ Username must be at least 3 characters.")
                     return
                 
-                df = load_accounts()
-                if not df[df["USERNAME"].str.lower() == username.lower()].empty:
+                if len(username.encode("utf-8")) > MAX_USERNAME_BYTES:
+                    await message.reply(f"❌ Username must be at most {MAX_USERNAME_BYTES} characters.")
+                    return
+                
+                # ":" separates callback data fields, so approve/reject buttons could not carry it
+                if AccountCB.__separator__ in username:
+                    await message.reply("❌ Username cannot contain ':'.")
+                    return
+                
+                await _aload_accounts(copy=False)
+                if find_account(username):
                     await message.reply("❌ Username already exists.")
                     user_state.pop(uid, None)
                     return
@@ -1727,16 +2834,14 @@ async def handle_all_messages(message: types.Message):
                 
                 username = state["username"]
                 
-                df = load_accounts()
                 new_row = {
                     "USERNAME": username,
-                    "PASSWORD": clean_password(password),
+                    "PASSWORD": hash_password(password),
                     "ROLE": "client",
                     "APPROVED": "NO"
                 }
                 
-                df = pd.concat([df, pd.DataFrame([new_row])], ignore_index=True)
-                save_accounts(df)
+                df = await run_blocking(add_account, new_row)
                 
                 user_state.pop(uid, None)
                 
@@ -1747,13 +2852,11 @@ async def handle_all_messages(message: types.Message):
                     "Use /login after approval."
                 )
                 
-                admin_df = df[df["ROLE"].str.lower() == "admin"]
-                for _, admin in admin_df.iterrows():
-                    save_notification(
-                        admin["USERNAME"],
-                        "admin",
-                        f"📝 New account pending approval: {username}"
-                    )
+                admin_names = df.loc[df["ROLE"].str.lower() == "admin", "USERNAME"].tolist()
+                await run_blocking(save_notifications_bulk, [
+                    (admin_name, "admin", f"📝 New account pending approval: {username}")
+                    for admin_name in admin_names
+                ])
                 
                 log_activity({"USERNAME": username, "ROLE": "client", "TELEGRAM_ID": uid}, "ACCOUNT_CREATED")
                 return
@@ -1770,28 +2873,16 @@ async def handle_all_messages(message: types.Message):
                 password = text
                 username = state.get("login_username", "")
                 
-                df = load_accounts()
+                df = await _aload_accounts(copy=False)
                 
                 if df.empty:
                     await message.reply("❌ No accounts found in system.")
                     user_state.pop(uid, None)
                     return
                 
-                df["USERNAME"] = df["USERNAME"].apply(clean_text)
-                df["PASSWORD"] = df["PASSWORD"].apply(clean_password)
-                df["APPROVED"] = df["APPROVED"].apply(clean_text).str.upper()
-                df["ROLE"] = df["ROLE"].apply(clean_text).str.lower()
-                
-                username_clean = clean_text(username)
-                password_clean = clean_password(password)
-                
-                user_row = df[
-                    (df["USERNAME"].str.lower() == username_clean.lower()) &
-                    (df["PASSWORD"] == password_clean) &
-                    (df["APPROVED"] == "YES")
-                ]
+                user_data = await run_blocking(authenticate_user, username, password)
                 
-                if user_row.empty:
+                if user_data is None:
                     await message.reply(
                         "❌ Invalid login credentials\n\n"
                         "Possible reasons:\n"
@@ -1803,16 +2894,15 @@ async def handle_all_messages(message: types.Message):
                     user_state.pop(uid, None)
                     return
                 
-                user_data = user_row.iloc[0].to_dict()
-                role = user_data["ROLE"].lower()
+                role = user_data["ROLE"]
                 
-                logged_in_users[uid] = {
+                set_session(uid, {
                     "USERNAME": user_data["USERNAME"],
                     "ROLE": role,
                     "SUPPLIER_KEY": f"supplier_{user_data['USERNAME'].lower()}" if role == "supplier" else None,
                     "last_active": time.time()
-                }
-                save_sessions()
+                })
+                await run_blocking(save_session, uid)
                 
                 log_activity(logged_in_users[uid], "LOGIN")
                 
@@ -1828,7 +2918,7 @@ async def handle_all_messages(message: types.Message):
                 
                 await message.reply(welcome_msg, reply_markup=kb)
                 
-                notifications = fetch_unread_notifications(user_data["USERNAME"], role)
+                notifications = await run_blocking(fetch_unread_notifications, user_data["USERNAME"], role)
                 if notifications:
                     note_msg = "🔔 **Unread Notifications**\n\n"
                     for note in notifications[:5]:
@@ -1843,11 +2933,11 @@ async def handle_all_messages(message: types.Message):
                 return
             
             elif state.get("step", "").startswith("search_"):
-                await handle_search_flow(message, state)
+                await handle_search_flow(message, state, user)
                 return
             
             elif state.get("step", "").startswith("deal_"):
-                await handle_deal_flow(message, state)
+                await handle_deal_flow(message, state, user)
                 return
         
         if user:
@@ -1863,7 +2953,7 @@ async def handle_all_messages(message: types.Message):
         await message.reply(f"❌ An error occurred. Use /fix to reset.")
 
 # ============= SEARCH FLOW HANDLER =============
-async def handle_search_flow(message: types.Message, state: Dict):
+async def handle_search_flow(message: types.Message, state: Dict, user: Optional[Dict[str, Any]]):
     """Handle diamond search flow"""
     try:
         uid = message.from_user.id
@@ -1901,56 +2991,44 @@ async def handle_search_flow(message: types.Message, state: Dict):
                 return
             search["clarity"] = text
             
-            user = get_logged_user(uid)
             if not user:
                 await message.reply("❌ Session expired. Please login again.")
                 user_state.pop(uid, None)
                 return
             
-            df = load_stock()
+            df = await _aload_stock()
             if df.empty:
                 await message.reply("❌ No diamonds available in stock.")
                 user_state.pop(uid, None)
                 return
             
-            filtered_df = df.copy()
+            # AND all criteria into one numpy mask in place so the frame is indexed only once
+            mask = np.ones(len(df), dtype=bool)
             
             if search["carat"] != "any":
                 try:
                     if "-" in search["carat"]:
                         min_carat, max_carat = map(float, search["carat"].split("-"))
-                        filtered_df = filtered_df[
-                            (filtered_df["Weight"] >= min_carat) & 
-                            (filtered_df["Weight"] <= max_carat)
-                        ]
                     else:
                         target_carat = float(search["carat"])
-                        filtered_df = filtered_df[
-                            (filtered_df["Weight"] >= target_carat * 0.9) & 
-                            (filtered_df["Weight"] <= target_carat * 1.1)
-                        ]
+                        min_carat, max_carat = target_carat * 0.9, target_carat * 1.1
+                    weights = df["Weight"].to_numpy(dtype=float, na_value=np.nan)
+                    mask &= (weights >= min_carat) & (weights <= max_carat)
                 except:
                     await message.reply("❌ Invalid carat format. Use like '1.5' or '1-2'")
                     user_state.pop(uid, None)
                     return
             
             if search["shape"] != "any":
-                shapes = [s.strip() for s in search["shape"].split(",")]
-                filtered_df = filtered_df[
-                    filtered_df["Shape"].str.lower().isin([s.lower() for s in shapes])
-                ]
+                mask &= df["_shape_l"].isin(set(split_grades(search["shape"]))).to_numpy()
             
             if search["color"] != "any":
-                colors = [c.strip().upper() for c in search["color"].split(",")]
-                filtered_df = filtered_df[
-                    filtered_df["Color"].str.upper().isin(colors)
-                ]
+                mask &= df["_color_l"].isin(split_grades(search["color"])).to_numpy()
             
             if search["clarity"] != "any":
-                clarities = [c.strip().upper() for c in search["clarity"].split(",")]
-                filtered_df = filtered_df[
-                    filtered_df["Clarity"].str.upper().isin(clarities)
-                ]
+                mask &= df["_clarity_l"].isin(split_grades(search["clarity"])).to_numpy()
+            
+            filtered_df = drop_helper_columns(df[mask])
             
             if filtered_df.empty:
                 await message.reply("❌ No diamonds match your search criteria.")
@@ -1961,13 +3039,12 @@ async def handle_search_flow(message: types.Message, state: Dict):
             total_carats = filtered_df["Weight"].sum() if "Weight" in filtered_df.columns else 0
             
             if total_diamonds > 10:
-                excel_path = "/tmp/search_results.xlsx"
-                filtered_df.to_excel(excel_path, index=False)
+                csv_data = await run_blocking(csv_bytes, filtered_df)
                 
                 await message.reply_document(
-                    types.FSInputFile(excel_path),
+                    BufferedInputFile(csv_data, filename="search_results.csv"),
                     caption=(
-                        f"💎 Found {total_diamonds} diamonds\n"
+                        f"💎 Found {total_diamonds} diamonds (CSV)\n"
                         f"📊 Total weight: {total_carats:.2f} ct\n"
                         f"🎯 Your filters:\n"
                         f"• Carat: {search['carat']}\n"
@@ -1976,22 +3053,26 @@ async def handle_search_flow(message: types.Message, state: Dict):
                         f"• Clarity: {search['clarity']}"
                     )
                 )
-                
-                if os.path.exists(excel_path):
-                    os.remove(excel_path)
             else:
-                for _, row in filtered_df.iterrows():
-                    msg = (
-                        f"💎 **{row['Stock #']}**\n"
-                        f"📐 Shape: {row.get('Shape', 'N/A')}\n"
-                        f"⚖️ Weight: {row.get('Weight', 'N/A')} ct\n"
-                        f"🎨 Color: {row.get('Color', 'N/A')}\n"
-                        f"✨ Clarity: {row.get('Clarity', 'N/A')}\n"
-                        f"💰 Price: ${row.get('Price Per Carat', 'N/A')}/ct\n"
-                        f"🔒 Status: {row.get('LOCKED', 'NO')}\n"
-                        f"🏛 Lab: {row.get('Lab', 'N/A')}"
+                # Columns absent from the stock show their placeholder, like row.get() did
+                defaults = {
+                    "Shape": "N/A", "Weight": "N/A", "Color": "N/A", "Clarity": "N/A",
+                    "Price Per Carat": "N/A", "LOCKED": "NO", "Lab": "N/A"
+                }
+                view = filtered_df.reindex(columns=["Stock #", *defaults]).assign(
+                    **{col: value for col, value in defaults.items() if col not in filtered_df.columns}
+                )
+                for stock_id, shape, weight, color, clarity, price, locked, lab in view.itertuples(index=False, name=None):
+                    await message.reply(
+                        f"💎 **{stock_id}**\n"
+                        f"📐 Shape: {shape}\n"
+                        f"⚖️ Weight: {weight} ct\n"
+                        f"🎨 Color: {color}\n"
+                        f"✨ Clarity: {clarity}\n"
+                        f"💰 Price: ${price}/ct\n"
+                        f"🔒 Status: {locked}\n"
+                        f"🏛 Lab: {lab}"
                     )
-                    await message.reply(msg)
             
             log_activity(user, "SEARCH", {
                 "filters": search,
@@ -2006,7 +3087,7 @@ async def handle_search_flow(message: types.Message, state: Dict):
         user_state.pop(uid, None)
 
 # ============= DEAL FLOW HANDLER =============
-async def handle_deal_flow(message: types.Message, state: Dict):
+async def handle_deal_flow(message: types.Message, state: Dict, user: Optional[Dict[str, Any]]):
     """Handle deal request flow"""
     try:
         uid = message.from_user.id
@@ -2035,7 +3116,6 @@ async def handle_deal_flow(message: types.Message, state: Dict):
                 await message.reply("❌ Please enter a valid number.")
                 return
             
-            user = get_logged_user(uid)
             if not user:
                 await message.reply("❌ Session expired. Please login again.")
                 user_state.pop(uid, None)
@@ -2043,57 +3123,36 @@ async def handle_deal_flow(message: types.Message, state: Dict):
             
             stone_id = state["stone_id"]
             
-            df = load_stock()
+            df = await _aload_stock()
             if df.empty:
                 await message.reply("❌ No stock available.")
                 user_state.pop(uid, None)
                 return
                 
-            stone_row = df[df["Stock #"] == stone_id]
+            stone_data = find_stone(stone_id)
             
-            if stone_row.empty:
+            if stone_data is None:
                 await message.reply("❌ Stone not found.")
                 user_state.pop(uid, None)
                 return
             
-            if stone_row.iloc[0].get("LOCKED") == "YES":
+            if stone_data.get("LOCKED") == "YES":
                 await message.reply("🔒 This stone is already locked in another deal.")
                 user_state.pop(uid, None)
                 return
             
-            deal_id = f"DEAL-{uuid.uuid4().hex[:10].upper()}"
-            stone_data = stone_row.iloc[0]
-            
-            deal = {
-                "deal_id": deal_id,
-                "stone_id": stone_id,
-                "supplier_username": stone_data.get("SUPPLIER", "").replace("supplier_", ""),
-                "client_username": user["USERNAME"],
-                "actual_stock_price": float(stone_data.get("Price Per Carat", 0)),
-                "client_offer_price": offer_price,
-                "supplier_action": "PENDING",
-                "admin_action": "PENDING",
-                "final_status": "OPEN",
-                "created_at": datetime.now(IST).strftime("%Y-%m-%d %H:%M:%S")
-            }
+            deal = new_deal(stone_data, user["USERNAME"], offer_price)
+            deal_id = deal["deal_id"]
             
-            if not atomic_lock_stone(stone_id):
+            if not await run_blocking(atomic_lock_stone, stone_id):
                 await message.reply("🔒 Stone is no longer available.")
                 user_state.pop(uid, None)
                 return
             
-            if s3:
-                deal_key = f"{DEALS_FOLDER}{deal_id}.json"
-                s3.put_object(
-                    Bucket=CONFIG["AWS_BUCKET"],
-                    Key=deal_key,
-                    Body=json.dumps(deal, indent=2),
-                    ContentType="application/json"
-                )
-            
-            log_deal_history(deal)
+            await run_blocking(store_deals, [deal])
             
-            save_notification(
+            await run_blocking(
+                save_notification,
                 deal["supplier_username"],
                 "supplier",
                 f"📩 New deal offer for Stone {stone_id}\n"
@@ -2122,6 +3181,70 @@ async def handle_deal_flow(message: types.Message, state: Dict):
         await message.reply(f"❌ Deal error: {type(e).__name__}. Please try again.")
         user_state.pop(uid, None)
 
+async def handle_bulk_deal_upload(message: types.Message, user: Dict, df: pd.DataFrame, processing_msg: types.Message):
+    """Client: Place offers from a filled bulk deal template"""
+    uid = message.from_user.id
+    try:
+        if "Stock #" not in df.columns or "Offer Price ($/ct)" not in df.columns:
+            await processing_msg.edit_text("❌ File must keep the 'Stock #' and 'Offer Price ($/ct)' columns from the template.")
+            return
+        
+        offers = pd.DataFrame({
+            "Stock #": df["Stock #"],
+            "Offer": pd.to_numeric(df["Offer Price ($/ct)"], errors="coerce")
+        }).dropna()
+        offers["Stock #"] = offers["Stock #"].astype(str).str.strip()
+        offers = offers[offers["Offer"] > 0].drop_duplicates("Stock #", keep="last")
+        
+        if offers.empty:
+            await processing_msg.edit_text("❌ No offer prices filled in. Enter a $/ct price for the stones you want.")
+            return
+        
+        stock = (await _aload_stock()).reindex(columns=["Stock #", "SUPPLIER", "Price Per Carat", "LOCKED"])
+        stock["Stock #"] = stock["Stock #"].astype(str)
+        available = offers.merge(stock.drop_duplicates("Stock #"), on="Stock #")
+        available = available[available["LOCKED"] != "YES"]
+        
+        # One lock transaction for the whole file instead of a stock rewrite per stone
+        locked = set(await run_blocking(lock_stones, available["Stock #"].tolist()))
+        
+        deals = [
+            new_deal({"Stock #": stone_id, "SUPPLIER": supplier, "Price Per Carat": price}, user["USERNAME"], float(offer))
+            for stone_id, offer, supplier, price in available[
+                ["Stock #", "Offer", "SUPPLIER", "Price Per Carat"]
+            ].itertuples(index=False, name=None)
+            if stone_id in locked
+        ]
+        await run_blocking(store_deals, deals)
+        
+        await run_blocking(save_notifications_bulk, [
+            (
+                deal["supplier_username"],
+                "supplier",
+                f"📩 New deal offer for Stone {deal['stone_id']}\n"
+                f"💰 Offer: ${deal['client_offer_price']}/ct"
+            )
+            for deal in deals
+        ])
+        
+        log_activity(user, "REQUEST_BULK_DEAL", {
+            "offers": len(offers),
+            "deal_ids": [deal["deal_id"] for deal in deals]
+        })
+        
+        skipped = len(offers) - len(deals)
+        await processing_msg.edit_text(
+            f"✅ Sent {len(deals)} deal request(s).\n"
+            + (f"⚠️ Skipped {skipped} stone(s) that were not found or already locked.\n" if skipped else "")
+            + "\nUse '🤝 View Deals' to check status."
+        )
+        user_state.pop(uid, None)
+        
+    except Exception as e:
+        logger.error(f"❌ Error in handle_bulk_deal_upload: {e}", exc_info=True)
+        await processing_msg.edit_text("❌ Failed to process bulk deal file. Please try again.")
+        user_state.pop(uid, None)
+
 # ============= LOGGED IN BUTTON HANDLERS =============
 async def handle_logged_in_buttons(message: types.Message, user: Dict):
     """Handle button presses for logged in users"""
@@ -2133,60 +3256,18 @@ async def handle_logged_in_buttons(message: types.Message, user: Dict):
         text = message.text
         role = user.get("ROLE", "").lower()
         
-        logger.info(f"Button pressed: {text} by {user['USERNAME']} (role: {role})")
+        logger.debug("Button pressed: %s by %s (role: %s)", text, user["USERNAME"], role)
         
         if not text:
             await message.reply("Please use the menu buttons.")
             return
         
-        if role == "admin":
-            if text == "💎 View All Stock":
-                await view_all_stock(message, user)
-            elif text == "👥 View Users":
-                await view_users(message, user)
-            elif text == "⏳ Pending Accounts":
-                await pending_accounts(message, user)
-            elif text == "🏆 Supplier Leaderboard":
-                await supplier_leaderboard(message, user)
-            elif text == "🤝 View Deals":
-                await view_deals(message, user)
-            elif text == "📑 User Activity Report":
-                await user_activity_report(message, user)
-            elif text == "🗑 Delete Supplier Stock":
-                await delete_supplier_stock(message, user)
-            elif text == "🚪 Logout":
-                await logout_command(message)
-            else:
-                await message.reply("Please use the menu buttons.")
-        
-        elif role == "supplier":
-            if text == "📤 Upload Excel":
-                await upload_excel_prompt(message, user)
-            elif text == "📦 My Stock":
-                await supplier_my_stock(message, user)
-            elif text == "📊 My Analytics":
-                await supplier_analytics(message, user)
-            elif text == "🤝 View Deals":
-                await view_deals(message, user)
-            elif text == "📥 Download Sample Excel":
-                await download_sample_excel(message, user)
-            elif text == "🚪 Logout":
-                await logout_command(message)
-            else:
-                await message.reply("Please use the menu buttons.")
-        
+        handler = BUTTON_ROUTES.get(role, BUTTON_ROUTES["client"]).get(text)
+        if handler:
+            await handler(message, user)
         else:
-            if text == "💎 Search Diamonds":
-                await search_diamonds_start(message, user)
-            elif text == "🔥 Smart Deals":
-                await smart_deals(message, user)
-            elif text == "🤝 Request Deal":
-                await request_deal_start(message, user)
-            elif text == "🚪 Logout":
-                await logout_command(message)
-            else:
-                await message.reply("Please use the menu buttons.")
-                
+            await message.reply("Please use the menu buttons.")
+        
     except Exception as e:
         logger.error(f"❌ Error in handle_logged_in_buttons: {e}")
         await message.reply(
@@ -2199,7 +3280,7 @@ async def handle_logged_in_buttons(message: types.Message, user: Dict):
 async def view_all_stock(message: types.Message, user: Dict):
     """Admin: View all stock"""
     try:
-        df = load_stock()
+        df = await _aload_stock()
         
         if df.empty:
             await message.reply("❌ No stock available.")
@@ -2219,22 +3300,17 @@ async def view_all_stock(message: types.Message, user: Dict):
         )
         
         shape_counts = df["Shape"].value_counts().head(5)
-        for shape, count in shape_counts.items():
-            summary += f"• {shape}: {count}\n"
+        summary += "".join(f"• {shape}: {count}\n" for shape, count in shape_counts.items())
         
         await message.reply(summary)
         
-        excel_path = "/tmp/all_stock.xlsx"
-        df.to_excel(excel_path, index=False)
+        excel_data = await run_blocking(excel_bytes, drop_helper_columns(df))
         
         await message.reply_document(
-            types.FSInputFile(excel_path),
+            BufferedInputFile(excel_data, filename="all_stock.xlsx"),
             caption=f"📊 Complete Stock List ({total_diamonds} diamonds)"
         )
         
-        if os.path.exists(excel_path):
-            os.remove(excel_path)
-        
         log_activity(user, "VIEW_ALL_STOCK")
         
     except Exception as e:
@@ -2244,14 +3320,14 @@ async def view_all_stock(message: types.Message, user: Dict):
 async def view_users(message: types.Message, user: Dict):
     """Admin: View all users"""
     try:
-        df = load_accounts()
+        df = await _aload_accounts(copy=False)
         
         if df.empty:
             await message.reply("❌ No users found.")
             return
         
-        role_stats = df.groupby("ROLE").size()
-        approval_stats = df.groupby("APPROVED").size()
+        role_stats = df.groupby("ROLE", observed=True, sort=False).size()
+        approval_stats = df.groupby("APPROVED", observed=True, sort=False).size()
         
         stats_msg = (
             f"📊 **User Statistics**\n\n"
@@ -2259,26 +3335,18 @@ async def view_users(message: types.Message, user: Dict):
             f"**By Role:**\n"
         )
         
-        for role, count in role_stats.items():
-            stats_msg += f"• {role.title()}: {count}\n"
+        stats_msg += "".join(f"• {role.title()}: {count}\n" for role, count in role_stats.items())
         
         stats_msg += f"\n**By Approval Status:**\n"
-        for status, count in approval_stats.items():
-            stats_msg += f"• {status}: {count}\n"
+        stats_msg += "".join(f"• {status}: {count}\n" for status, count in approval_stats.items())
         
         await message.reply(stats_msg)
         
-        excel_path = "/tmp/all_users.xlsx"
-        df.to_excel(excel_path, index=False)
-        
         await message.reply_document(
-            types.FSInputFile(excel_path),
+            BufferedInputFile(await run_blocking(export_accounts_xlsx, df), filename="all_users.xlsx"),
             caption=f"👥 User List ({len(df)} users)"
         )
         
-        if os.path.exists(excel_path):
-            os.remove(excel_path)
-        
         log_activity(user, "VIEW_USERS")
         
     except Exception as e:
@@ -2288,7 +3356,7 @@ async def view_users(message: types.Message, user: Dict):
 async def pending_accounts(message: types.Message, user: Dict):
     """Admin: View pending accounts"""
     try:
-        df = load_accounts()
+        df = await _aload_accounts(copy=False)
         
         pending_df = df[df["APPROVED"] != "YES"]
         
@@ -2296,15 +3364,20 @@ async def pending_accounts(message: types.Message, user: Dict):
             await message.reply("✅ No pending accounts.")
             return
         
-        for _, row in pending_df.iterrows():
-            kb = InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text="✅ Approve", callback_data=f"approve:{row['USERNAME']}"),
-                InlineKeyboardButton(text="❌ Reject", callback_data=f"reject:{row['USERNAME']}")
-            ]])
+        for username, role in pending_df[["USERNAME", "ROLE"]].itertuples(index=False, name=None):
+            try:
+                kb = InlineKeyboardMarkup(inline_keyboard=[[
+                    InlineKeyboardButton(text="✅ Approve", callback_data=AccountCB(action="approve", username=username).pack()),
+                    InlineKeyboardButton(text="❌ Reject", callback_data=AccountCB(action="reject", username=username).pack())
+                ]])
+            except ValueError as e:
+                # Accounts created before the signup checks may not fit in callback data
+                logger.warning(f"⚠️ No approval buttons for {username}: {e}")
+                kb = None
             
             await message.reply(
-                f"👤 **Username:** {row['USERNAME']}\n"
-                f"🔑 **Role:** {row['ROLE']}\n"
+                f"👤 **Username:** {username}\n"
+                f"🔑 **Role:** {role}\n"
                 f"⏳ **Status:** Pending Approval",
                 reply_markup=kb
             )
@@ -2318,46 +3391,41 @@ async def pending_accounts(message: types.Message, user: Dict):
 async def supplier_leaderboard(message: types.Message, user: Dict):
     """Admin: Supplier leaderboard"""
     try:
-        df = load_stock()
+        df = await _aload_stock()
         
         if df.empty or "SUPPLIER" not in df.columns:
             await message.reply("❌ No supplier data available.")
             return
         
-        supplier_stats = df.groupby("SUPPLIER").agg(
-            Stones=("SUPPLIER", "count"),
+        supplier_stats = df.assign(
+            Value=df["Weight"] * df["Price Per Carat"]
+        ).groupby("SUPPLIER", observed=True, sort=False).agg(
+            Stones=("SUPPLIER", "size"),
             Total_Carats=("Weight", "sum"),
             Avg_Price_Per_Carat=("Price Per Carat", "mean"),
-            Total_Value=("Weight", lambda x: (x * df.loc[x.index, "Price Per Carat"]).sum())
+            Total_Value=("Value", "sum")
         ).round(2)
         
         supplier_stats = supplier_stats.sort_values("Stones", ascending=False)
         
-        leaderboard_msg = "🏆 **Supplier Leaderboard**\n\n"
-        
-        for i, (supplier, stats) in enumerate(supplier_stats.head(10).iterrows(), 1):
-            supplier_name = supplier.replace("supplier_", "").title()
-            leaderboard_msg += (
-                f"{i}. **{supplier_name}**\n"
-                f"   💎 Stones: {stats['Stones']}\n"
-                f"   ⚖️ Carats: {stats['Total_Carats']:.2f}\n"
-                f"   💰 Avg Price: ${stats['Avg_Price_Per_Carat']:,.2f}/ct\n"
-                f"   🏦 Total Value: ${stats['Total_Value']:,.2f}\n\n"
-            )
+        leaderboard_msg = "🏆 **Supplier Leaderboard**\n\n" + "".join(
+            f"{i}. **{row.Index.removeprefix('supplier_').title()}**\n"
+            f"   💎 Stones: {row.Stones}\n"
+            f"   ⚖️ Carats: {row.Total_Carats:.2f}\n"
+            f"   💰 Avg Price: ${row.Avg_Price_Per_Carat:,.2f}/ct\n"
+            f"   🏦 Total Value: ${row.Total_Value:,.2f}\n\n"
+            for i, row in enumerate(supplier_stats.head(10).itertuples(), 1)
+        )
         
         await message.reply(leaderboard_msg)
         
-        excel_path = "/tmp/supplier_leaderboard.xlsx"
-        supplier_stats.to_excel(excel_path)
+        excel_data = await run_blocking(excel_bytes, supplier_stats.reset_index())
         
         await message.reply_document(
-            types.FSInputFile(excel_path),
+            BufferedInputFile(excel_data, filename="supplier_leaderboard.xlsx"),
             caption="📊 Supplier Leaderboard Details"
         )
         
-        if os.path.exists(excel_path):
-            os.remove(excel_path)
-        
         log_activity(user, "VIEW_SUPPLIER_LEADERBOARD")
         
     except Exception as e:
@@ -2367,57 +3435,20 @@ async def supplier_leaderboard(message: types.Message, user: Dict):
 async def user_activity_report(message: types.Message, user: Dict):
     """Admin: Generate activity report"""
     try:
-        objs = s3.list_objects_v2(
-            Bucket=CONFIG["AWS_BUCKET"],
-            Prefix=ACTIVITY_LOG_FOLDER
-        )
-
-        if "Contents" not in objs or not objs["Contents"]:
-            await message.reply("❌ No activity logs found.")
-            return
-
-        rows = []
-
-        for obj in objs["Contents"]:
-            if not obj["Key"].endswith(".json"):
-                continue
-
-            try:
-                raw = s3.get_object(
-                    Bucket=CONFIG["AWS_BUCKET"],
-                    Key=obj["Key"]
-                )["Body"].read().decode("utf-8")
-
-                data = json.loads(raw)
-                for entry in data:
-                    rows.append({
-                        "Date": entry.get("date"),
-                        "Time": entry.get("time"),
-                        "Login ID": entry.get("login_id"),
-                        "Role": entry.get("role"),
-                        "Action": entry.get("action"),
-                        "Details": json.dumps(entry.get("details", {}))
-                    })
-            except Exception as e:
-                logger.error(f"Failed to read activity file {obj['Key']}: {e}")
-                continue
+        df = await run_blocking(load_activity_report)
 
-        if not rows:
+        if df.empty:
             await message.reply("❌ No activity logs found.")
             return
 
-        df = pd.DataFrame(rows)
-        path = "/tmp/user_activity_report.xlsx"
-        df.to_excel(path, index=False)
+        df = df.sort_values(["Date", "Time"], kind="stable")
+        excel_data = await run_blocking(excel_bytes, df)
         
         await message.reply_document(
-            types.FSInputFile(path),
-            caption=f"📑 User Activity Report ({len(rows)} entries)"
+            BufferedInputFile(excel_data, filename="user_activity_report.xlsx"),
+            caption=f"📑 User Activity Report ({len(df)} entries)"
         )
         
-        if os.path.exists(path):
-            os.remove(path)
-        
         log_activity(user, "DOWNLOAD_ACTIVITY_REPORT")
 
     except Exception as e:
@@ -2482,10 +3513,10 @@ async def supplier_my_stock(message: types.Message, user: Dict):
         stock_key = f"{SUPPLIER_STOCK_FOLDER}{supplier_key}.xlsx"
         
         try:
-            local_path = "/tmp/my_stock.xlsx"
-            s3.download_file(CONFIG["AWS_BUCKET"], stock_key, local_path)
+            obj = await run_blocking(s3.get_object, Bucket=AWS_BUCKET, Key=stock_key)
+            payload = await run_blocking(obj["Body"].read)
             
-            df = pd.read_excel(local_path)
+            df = await run_blocking(_read_excel, BytesIO(payload))
             
             total_stones = len(df)
             total_carats = df["Weight"].sum() if "Weight" in df.columns else 0
@@ -2504,13 +3535,12 @@ async def supplier_my_stock(message: types.Message, user: Dict):
                 shape_counts = df["Shape"].value_counts().head(5)
                 if not shape_counts.empty:
                     stats_msg += f"**Stock Distribution:**\n"
-                    for shape, count in shape_counts.items():
-                        stats_msg += f"• {shape}: {count}\n"
+                    stats_msg += "".join(f"• {shape}: {count}\n" for shape, count in shape_counts.items())
             
             await message.reply(stats_msg)
             
             await message.reply_document(
-                types.FSInputFile(local_path),
+                BufferedInputFile(payload, filename="my_stock.xlsx"),
                 caption=f"📦 Your Stock File ({total_stones} diamonds)"
             )
             
@@ -2522,65 +3552,61 @@ async def supplier_my_stock(message: types.Message, user: Dict):
     except Exception as e:
         logger.error(f"❌ Error in supplier_my_stock: {e}")
         await message.reply("❌ Failed to load stock data.")
-    finally:
-        if os.path.exists("/tmp/my_stock.xlsx"):
-            os.remove("/tmp/my_stock.xlsx")
 
 async def supplier_analytics(message: types.Message, user: Dict):
     """Supplier: Price analytics"""
     try:
         supplier_key = user.get("SUPPLIER_KEY", f"supplier_{user['USERNAME'].lower()}")
         
-        df = load_stock()
+        df = await _aload_stock()
         if df.empty:
             await message.reply("❌ No market data available.")
             return
         
-        my_stones = df[df["SUPPLIER"].str.lower() == supplier_key.lower()]
+        my_stones = df[df["_supplier_l"] == supplier_key.lower()]
         
         if my_stones.empty:
             await message.reply("❌ You have no stones in the market.")
             return
         
-        results = []
+        df["MATCH_KEY"] = grade_match_key(df)
+        graded = df[df["MATCH_KEY"] >= 0]
         
-        for _, stone in my_stones.iterrows():
-            similar = df[
-                (df["Shape"] == stone["Shape"]) &
-                (df["Color"] == stone["Color"]) &
-                (df["Clarity"] == stone["Clarity"]) &
-                (df["Diamond Type"] == stone.get("Diamond Type", "")) &
-                (abs(df["Weight"] - stone["Weight"]) <= 0.2)
-            ]
-            
-            if len(similar) > 1:
-                market_avg = similar["Price Per Carat"].mean()
-                my_price = stone["Price Per Carat"]
-                price_diff = my_price - market_avg
-                price_diff_pct = (price_diff / market_avg * 100) if market_avg > 0 else 0
-                
-                results.append({
-                    "Stock #": stone["Stock #"],
-                    "Weight": stone["Weight"],
-                    "Shape": stone["Shape"],
-                    "Color": stone["Color"],
-                    "Clarity": stone["Clarity"],
-                    "Your Price": my_price,
-                    "Market Avg": market_avg,
-                    "Price Diff": price_diff,
-                    "Diff %": price_diff_pct,
-                    "Status": "Above Market" if price_diff > 0 else "Below Market" if price_diff < 0 else "Market Average"
-                })
+        # Peers share the grade and a 0.2ct weight band; one grouped pass instead of pairing every stone
+        weight_band = np.floor(graded["Weight"] / 0.2)
+        peers = graded.groupby([graded["MATCH_KEY"], weight_band], sort=False)["Price Per Carat"]
+        peer_median = peers.transform("median")
+        peer_count = peers.transform("size")
         
-        if not results:
+        comparable = graded.index.isin(my_stones.index) & (peer_count > 1).to_numpy()
+        if not comparable.any():
             await message.reply("ℹ️ No comparable stones found in market for analysis.")
             return
         
-        results_df = pd.DataFrame(results)
+        matched = graded[comparable]
+        market_avg = peer_median[comparable]
+        price_diff = matched["Price Per Carat"] - market_avg
+        
+        results_df = pd.DataFrame({
+            "Stock #": matched["Stock #"],
+            "Weight": matched["Weight"],
+            "Shape": matched["Shape"],
+            "Color": matched["Color"],
+            "Clarity": matched["Clarity"],
+            "Your Price": matched["Price Per Carat"],
+            "Market Avg": market_avg,
+            "Price Diff": price_diff,
+            "Diff %": np.where(market_avg > 0, price_diff / market_avg * 100, 0),
+            "Status": np.select(
+                [price_diff > 0, price_diff < 0],
+                ["Above Market", "Below Market"],
+                default="Market Average"
+            )
+        }).reset_index(drop=True)
         results_df = results_df.sort_values("Diff %", ascending=False)
         
-        above_market = len(results_df[results_df["Diff %"] > 5])
-        below_market = len(results_df[results_df["Diff %"] < -5])
+        above_market = int((results_df["Diff %"] > 5).sum())
+        below_market = int((results_df["Diff %"] < -5).sum())
         in_range = len(results_df) - above_market - below_market
         
         summary_msg = (
@@ -2602,79 +3628,78 @@ async def supplier_analytics(message: types.Message, user: Dict):
         
         await message.reply(summary_msg)
         
-        excel_path = "/tmp/price_analytics.xlsx"
-        results_df.to_excel(excel_path, index=False)
+        csv_data = await run_blocking(csv_bytes, results_df)
         
         await message.reply_document(
-            types.FSInputFile(excel_path),
-            caption=f"📊 Detailed Price Analysis ({len(results_df)} stones)"
+            BufferedInputFile(csv_data, filename=f"{user['USERNAME']}_price_analytics.csv"),
+            caption=f"📊 Detailed Price Analysis ({len(results_df)} stones, CSV)"
         )
         
-        if os.path.exists(excel_path):
-            os.remove(excel_path)
-        
         log_activity(user, "VIEW_ANALYTICS")
         
     except Exception as e:
         logger.error(f"❌ Error in supplier_analytics: {e}")
         await message.reply("❌ Failed to load analytics data.")
 
+@functools.lru_cache(maxsize=1)
+def sample_template_bytes() -> bytes:
+    """Build the static supplier upload template once and reuse its bytes"""
+    sample_data = {
+        "Stock #": ["D001", "D002", "D003"],
+        "Shape": ["Round", "Oval", "Princess"],
+        "Weight": [1.0, 1.5, 2.0],
+        "Color": ["D", "E", "F"],
+        "Clarity": ["VVS1", "VS1", "SI1"],
+        "Price Per Carat": [10000, 8500, 7000],
+        "Lab": ["GIA", "IGI", "HRD"],
+        "Report #": ["1234567890", "2345678901", "3456789012"],
+        "Diamond Type": ["Natural", "Natural", "LGD"],
+        "Description": ["Excellent cut round", "Nice oval diamond", "Good princess cut"],
+        
+        "CUT": ["EX", "VG", ""],
+        "Polish": ["EX", "", "VG"],
+        "Symmetry": ["EX", "VG", ""]
+    }
+    
+    df = pd.DataFrame(sample_data)
+    
+    buffer = BytesIO()
+    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='Stock')
+        
+        instructions = pd.DataFrame({
+            "Column": DiamondExcelValidator.ALL_COLUMNS,
+            "Required": ["Yes"] * len(DiamondExcelValidator.REQUIRED_COLUMNS) + 
+                       ["No"] * len(DiamondExcelValidator.OPTIONAL_COLUMNS),
+            "Description": [
+                "Unique identifier for each diamond",
+                "Shape of diamond (Round, Oval, Princess, etc.)",
+                "Weight in carats (e.g., 1.0, 1.5)",
+                "Color grade (D, E, F, etc.)",
+                "Clarity grade (VVS1, VS1, SI1, etc.)",
+                "Price per carat in USD",
+                "Certification lab (GIA, IGI, HRD, etc.)",
+                "Certificate number",
+                "Type (Natural, LGD, HPHT)",
+                "Brief description of the diamond",
+                "Cut grade (EX, VG, G, F, P) - CAN BE BLANK",
+                "Polish grade (EX, VG, G, F, P) - CAN BE BLANK",
+                "Symmetry grade (EX, VG, G, F, P) - CAN BE BLANK"
+            ],
+            "Example": [
+                "D001", "Round", "1.0", "D", "VVS1", "10000", "GIA", "123456", "Natural", "Excellent cut",
+                "EX", "EX", "EX"
+            ]
+        })
+        instructions.to_excel(writer, index=False, sheet_name='Instructions')
+    
+    return buffer.getvalue()
+
 async def download_sample_excel(message: types.Message, user: Dict):
     """Supplier: Download sample Excel template"""
     try:
-        sample_data = {
-            "Stock #": ["D001", "D002", "D003"],
-            "Shape": ["Round", "Oval", "Princess"],
-            "Weight": [1.0, 1.5, 2.0],
-            "Color": ["D", "E", "F"],
-            "Clarity": ["VVS1", "VS1", "SI1"],
-            "Price Per Carat": [10000, 8500, 7000],
-            "Lab": ["GIA", "IGI", "HRD"],
-            "Report #": ["1234567890", "2345678901", "3456789012"],
-            "Diamond Type": ["Natural", "Natural", "LGD"],
-            "Description": ["Excellent cut round", "Nice oval diamond", "Good princess cut"],
-            
-            "CUT": ["EX", "VG", ""],
-            "Polish": ["EX", "", "VG"],
-            "Symmetry": ["EX", "VG", ""]
-        }
-        
-        df = pd.DataFrame(sample_data)
-        
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Stock')
-            
-            instructions = pd.DataFrame({
-                "Column": DiamondExcelValidator.ALL_COLUMNS,
-                "Required": ["Yes"] * len(DiamondExcelValidator.REQUIRED_COLUMNS) + 
-                           ["No"] * len(DiamondExcelValidator.OPTIONAL_COLUMNS),
-                "Description": [
-                    "Unique identifier for each diamond",
-                    "Shape of diamond (Round, Oval, Princess, etc.)",
-                    "Weight in carats (e.g., 1.0, 1.5)",
-                    "Color grade (D, E, F, etc.)",
-                    "Clarity grade (VVS1, VS1, SI1, etc.)",
-                    "Price per carat in USD",
-                    "Certification lab (GIA, IGI, HRD, etc.)",
-                    "Certificate number",
-                    "Type (Natural, LGD, HPHT)",
-                    "Brief description of the diamond",
-                    "Cut grade (EX, VG, G, F, P) - CAN BE BLANK",
-                    "Polish grade (EX, VG, G, F, P) - CAN BE BLANK",
-                    "Symmetry grade (EX, VG, G, F, P) - CAN BE BLANK"
-                ],
-                "Example": [
-                    "D001", "Round", "1.0", "D", "VVS1", "10000", "GIA", "123456", "Natural", "Excellent cut",
-                    "EX", "EX", "EX"
-                ]
-            })
-            instructions.to_excel(writer, index=False, sheet_name='Instructions')
-        
-        buffer.seek(0)
-        
         await message.reply_document(
-            BufferedInputFile(buffer.read(), filename="diamond_stock_template.xlsx"),
+            BufferedInputFile(sample_template_bytes(), filename="diamond_stock_template.xlsx"),
             caption=(
                 "📥 **Sample Stock Upload Template**\n\n"
                 "This Excel file contains:\n"
@@ -2723,17 +3748,19 @@ async def search_diamonds_start(message: types.Message, user: Dict):
 async def smart_deals(message: types.Message, user: Dict):
     """Client: Find smart deals (discounted diamonds)"""
     try:
-        df = load_stock()
+        df = await _aload_stock()
         
         if df.empty:
             await message.reply("❌ No diamonds available.")
             return
         
-        df["Price Per Carat"] = pd.to_numeric(df["Price Per Carat"], errors="coerce")
-        df["Weight"] = pd.to_numeric(df["Weight"], errors="coerce")
-        
-        group_cols = ["Shape", "Color", "Clarity", "Diamond Type"]
-        df["Market_Avg"] = df.groupby(group_cols)["Price Per Carat"].transform("median")
+        df = df.copy(deep=False)
+        medians = market_medians(df)
+        df["Market_Avg"] = pd.Series(
+            [medians.get(key) for key in df[MARKET_GROUP_COLS].itertuples(index=False, name=None)],
+            index=df.index,
+            dtype="float64"
+        )
         
         df["Discount_%"] = ((df["Market_Avg"] - df["Price Per Carat"]) / df["Market_Avg"] * 100).round(1)
         
@@ -2743,34 +3770,38 @@ async def smart_deals(message: types.Message, user: Dict):
             await message.reply("😔 No strong deals found right now.")
             return
         
+        # Render the full list while the top-5 summary is being sent
+        xlsx_task = asyncio.ensure_future(run_blocking(
+            excel_bytes,
+            good_deals.reindex(columns=["Stock #", "Shape", "Weight", "Color", "Clarity", "Price Per Carat", "Discount_%", "Lab"])
+        )) if len(good_deals) > 5 else None
+        
         top_deals = good_deals.head(5)
         
         deals_msg = "🔥 **Smart Deals Found**\n\n"
         deals_msg += f"Found {len(good_deals)} diamonds priced 10%+ below market\n\n"
         
-        for i, (_, deal) in enumerate(top_deals.iterrows(), 1):
-            deals_msg += (
-                f"{i}. 💎 **{deal['Stock #']}**\n"
-                f"   📐 {deal['Shape']} | ⚖️ {deal['Weight']}ct\n"
-                f"   🎨 {deal['Color']} | ✨ {deal['Clarity']}\n"
-                f"   💰 ${deal['Price Per Carat']:,.0f}/ct\n"
-                f"   📉 {deal['Discount_%']}% below market\n"
-                f"   🔒 Status: {deal.get('LOCKED', 'NO')}\n\n"
-            )
+        deal_rows = top_deals.reindex(columns=[
+            "Stock #", "Shape", "Weight", "Color", "Clarity", "Price Per Carat", "Discount_%", "LOCKED"
+        ]).fillna({"LOCKED": "NO"})
+        deals_msg += "".join(
+            f"{i}. 💎 **{stock_id}**\n"
+            f"   📐 {shape} | ⚖️ {weight}ct\n"
+            f"   🎨 {color} | ✨ {clarity}\n"
+            f"   💰 ${price:,.0f}/ct\n"
+            f"   📉 {discount}% below market\n"
+            f"   🔒 Status: {locked}\n\n"
+            for i, (stock_id, shape, weight, color, clarity, price, discount, locked)
+            in enumerate(deal_rows.itertuples(index=False, name=None), 1)
+        )
         
         await message.reply(deals_msg)
         
-        if len(good_deals) > 5:
-            excel_path = "/tmp/smart_deals.xlsx"
-            good_deals[["Stock #", "Shape", "Weight", "Color", "Clarity", "Price Per Carat", "Discount_%", "Lab"]].to_excel(excel_path, index=False)
-            
+        if xlsx_task:
             await message.reply_document(
-                types.FSInputFile(excel_path),
+                BufferedInputFile(await xlsx_task, filename="smart_deals.xlsx"),
                 caption=f"📊 Complete Smart Deals List ({len(good_deals)} diamonds)"
             )
-            
-            if os.path.exists(excel_path):
-                os.remove(excel_path)
         
         log_activity(user, "VIEW_SMART_DEALS")
         
@@ -2781,27 +3812,23 @@ async def smart_deals(message: types.Message, user: Dict):
 async def request_deal_start(message: types.Message, user: Dict):
     """Client: Start deal request process"""
     try:
-        df = load_stock()
+        df = await _aload_stock()
         
         if df.empty:
             await message.reply("❌ No diamonds available for deals.")
             return
         
         if len(df) > 20:
-            template_df = pd.DataFrame(columns=["Stock #", "Offer Price ($/ct)"])
-            
             available_stones = df[df["LOCKED"] != "YES"].head(10)
-            for _, stone in available_stones.iterrows():
-                template_df = pd.concat([template_df, pd.DataFrame([{
-                    "Stock #": stone["Stock #"],
-                    "Offer Price ($/ct)": ""
-                }])], ignore_index=True)
+            template_df = pd.DataFrame({
+                "Stock #": available_stones["Stock #"].tolist(),
+                "Offer Price ($/ct)": ""
+            }, columns=BULK_DEAL_COLUMNS)
             
-            excel_path = "/tmp/deal_request_template.xlsx"
-            template_df.to_excel(excel_path, index=False)
+            template_bytes = await run_blocking(excel_bytes, template_df)
             
             await message.reply_document(
-                types.FSInputFile(excel_path),
+                BufferedInputFile(template_bytes, filename="deal_request_template.xlsx"),
                 caption=(
                     "📊 **Bulk Deal Request Template**\n\n"
                     "**Instructions:**\n"
@@ -2820,9 +3847,6 @@ async def request_deal_start(message: types.Message, user: Dict):
                 "step": "bulk_deal_excel",
                 "last_updated": time.time()
             }
-            
-            if os.path.exists(excel_path):
-                os.remove(excel_path)
                 
         else:
             user_state[message.from_user.id] = {
@@ -2839,13 +3863,15 @@ async def request_deal_start(message: types.Message, user: Dict):
             
             stones_msg = "💎 **Available Stones for Deal**\n\n"
             
-            for _, stone in available_stones.iterrows():
-                stones_msg += (
-                    f"• **{stone['Stock #']}**\n"
-                    f"  {stone['Shape']} | {stone['Weight']}ct\n"
-                    f"  {stone['Color']} | {stone['Clarity']}\n"
-                    f"  ${stone['Price Per Carat']:,.0f}/ct\n\n"
-                )
+            stones_msg += "".join(
+                f"• **{stock_id}**\n"
+                f"  {shape} | {weight}ct\n"
+                f"  {color} | {clarity}\n"
+                f"  ${price:,.0f}/ct\n\n"
+                for stock_id, shape, weight, color, clarity, price in available_stones[
+                    ["Stock #", "Shape", "Weight", "Color", "Clarity", "Price Per Carat"]
+                ].itertuples(index=False, name=None)
+            )
             
             stones_msg += "Enter the **Stock #** of the stone you want to make an offer on:"
             
@@ -2865,38 +3891,12 @@ async def view_deals(message: types.Message, user: Dict):
             await message.reply("❌ AWS connection not available.")
             return
             
-        objs = s3.list_objects_v2(
-            Bucket=CONFIG["AWS_BUCKET"],
-            Prefix=DEALS_FOLDER
-        )
-        
-        if "Contents" not in objs:
-            await message.reply("ℹ️ No deals found.")
-            return
-        
-        deals = []
-        for obj in objs["Contents"]:
-            if not obj["Key"].endswith(".json"):
-                continue
-            
-            try:
-                deal_data = s3.get_object(
-                    Bucket=CONFIG["AWS_BUCKET"],
-                    Key=obj["Key"]
-                )["Body"].read().decode("utf-8")
-                
-                deal = json.loads(deal_data)
-                deals.append(deal)
-            except Exception as e:
-                logger.error(f"Failed to load deal {obj['Key']}: {e}")
-                continue
+        deals = await run_blocking(load_deals_index)
         
-        if not deals:
+        if deals.empty:
             await message.reply("ℹ️ No deals available.")
             return
         
-        deals.sort(key=lambda x: x.get("created_at", ""), reverse=True)
-        
         user_role = user["ROLE"]
         username = user["USERNAME"].lower()
         
@@ -2905,76 +3905,86 @@ async def view_deals(message: types.Message, user: Dict):
             title = "All Deals"
             
         elif user_role == "supplier":
-            filtered_deals = [
-                d for d in deals 
-                if d.get("supplier_username", "").lower() == username
-            ]
+            filtered_deals = deals[deals["supplier_username"].fillna("").str.lower() == username]
             title = "Your Deals"
             
         elif user_role == "client":
-            filtered_deals = [
-                d for d in deals 
-                if d.get("client_username", "").lower() == username
-            ]
+            filtered_deals = deals[deals["client_username"].fillna("").str.lower() == username]
             title = "Your Deal Requests"
             
         else:
             await message.reply("❌ Unauthorized access.")
             return
         
-        if not filtered_deals:
+        if filtered_deals.empty:
             await message.reply(f"ℹ️ No {title.lower()} found.")
             return
         
+        filtered_deals = filtered_deals.sort_values("created_at", ascending=False, na_position="last")
+        
         summary_msg = f"🤝 **{title}**\n\n"
         summary_msg += f"Total: {len(filtered_deals)} deals\n\n"
         
-        status_counts = {}
-        for deal in filtered_deals:
-            status = deal.get("final_status", "OPEN")
-            status_counts[status] = status_counts.get(status, 0) + 1
-        
-        for status, count in status_counts.items():
-            summary_msg += f"• {status}: {count}\n"
+        status_counts = filtered_deals["final_status"].fillna("OPEN").value_counts(sort=False)
+        summary_msg += "".join(f"• {status}: {count}\n" for status, count in status_counts.items())
         
         await message.reply(summary_msg)
         
-        excel_data = []
-        for deal in filtered_deals:
-            excel_data.append({
-                "Deal ID": deal.get("deal_id"),
-                "Stone ID": deal.get("stone_id"),
-                "Supplier": deal.get("supplier_username"),
-                "Client": deal.get("client_username"),
-                "Actual Price": deal.get("actual_stock_price"),
-                "Offer Price": deal.get("client_offer_price"),
-                "Supplier Action": deal.get("supplier_action"),
-                "Admin Action": deal.get("admin_action"),
-                "Final Status": deal.get("final_status"),
-                "Created At": deal.get("created_at")
-            })
+        df = filtered_deals.rename(columns=DEAL_EXPORT_COLUMNS)
         
-        df = pd.DataFrame(excel_data)
-        excel_path = f"/tmp/{username}_deals.xlsx"
-        df.to_excel(excel_path, index=False)
+        # Admins review deals in Excel; suppliers and clients get a plain CSV
+        if user_role == "admin":
+            export = BufferedInputFile(await run_blocking(excel_bytes, df), filename=f"{username}_deals.xlsx")
+            caption = f"📊 {title} Details"
+        else:
+            export = BufferedInputFile(await run_blocking(csv_bytes, df), filename=f"{username}_deals.csv")
+            caption = f"📊 {title} Details (CSV)"
         
         await message.reply_document(
-            types.FSInputFile(excel_path),
-            caption=f"📊 {title} Details"
+            export,
+            caption=caption
         )
         
-        if os.path.exists(excel_path):
-            os.remove(excel_path)
-        
         log_activity(user, f"VIEW_{user_role.upper()}_DEALS")
         
     except Exception as e:
         logger.error(f"❌ Error in view_deals: {e}")
         await message.reply("❌ Failed to load deals.")
 
+# ============= BUTTON ROUTING =============
+async def logout_button(message: types.Message, user: Dict):
+    await logout_command(message)
+
+BUTTON_ROUTES = {
+    "admin": {
+        "💎 View All Stock": view_all_stock,
+        "👥 View Users": view_users,
+        "⏳ Pending Accounts": pending_accounts,
+        "🏆 Supplier Leaderboard": supplier_leaderboard,
+        "🤝 View Deals": view_deals,
+        "📑 User Activity Report": user_activity_report,
+        "🗑 Delete Supplier Stock": delete_supplier_stock,
+        "🚪 Logout": logout_button,
+    },
+    "supplier": {
+        "📤 Upload Excel": upload_excel_prompt,
+        "📦 My Stock": supplier_my_stock,
+        "📊 My Analytics": supplier_analytics,
+        "🤝 View Deals": view_deals,
+        "📥 Download Sample Excel": download_sample_excel,
+        "🚪 Logout": logout_button,
+    },
+    "client": {
+        "💎 Search Diamonds": search_diamonds_start,
+        "🔥 Smart Deals": smart_deals,
+        "🤝 Request Deal": request_deal_start,
+        "🚪 Logout": logout_button,
+    },
+}
+
 # ============= CALLBACK QUERY HANDLERS =============
-@dp.callback_query(F.data.startswith("approve:"))
-async def approve_user_callback(callback: types.CallbackQuery):
+@dp.callback_query(AccountCB.filter(F.action == "approve"))
+async def approve_user_callback(callback: types.CallbackQuery, callback_data: AccountCB):
     """Approve pending user account"""
     try:
         admin = get_logged_user(callback.from_user.id)
@@ -2983,18 +3993,18 @@ async def approve_user_callback(callback: types.CallbackQuery):
             await callback.answer("❌ Admin only", show_alert=True)
             return
         
-        username = callback.data.split(":")[1]
+        username = callback_data.username
         
-        df = load_accounts()
+        df = await _aload_accounts()
         
         if df[df["USERNAME"] == username].empty:
             await callback.answer("❌ User not found", show_alert=True)
             return
         
         df.loc[df["USERNAME"] == username, "APPROVED"] = "YES"
-        save_accounts(df)
+        await run_blocking(save_accounts, df)
         
-        save_notification(username, "client", "✅ Your account has been approved by admin!")
+        await run_blocking(save_notification, username, "client", "✅ Your account has been approved by admin!")
         
         log_activity(admin, "APPROVE_USER", {"username": username})
         
@@ -3008,8 +4018,8 @@ async def approve_user_callback(callback: types.CallbackQuery):
         logger.error(f"❌ Error in approve_user_callback: {e}")
         await callback.answer("❌ Error approving user", show_alert=True)
 
-@dp.callback_query(F.data.startswith("reject:"))
-async def reject_user_callback(callback: types.CallbackQuery):
+@dp.callback_query(AccountCB.filter(F.action == "reject"))
+async def reject_user_callback(callback: types.CallbackQuery, callback_data: AccountCB):
     """Reject pending user account"""
     try:
         admin = get_logged_user(callback.from_user.id)
@@ -3018,16 +4028,16 @@ async def reject_user_callback(callback: types.CallbackQuery):
             await callback.answer("❌ Admin only", show_alert=True)
             return
         
-        username = callback.data.split(":")[1]
+        username = callback_data.username
         
-        df = load_accounts()
+        df = await _aload_accounts()
         
         if df[df["USERNAME"] == username].empty:
             await callback.answer("❌ User not found", show_alert=True)
             return
         
         df = df[df["USERNAME"] != username]
-        save_accounts(df)
+        await run_blocking(save_accounts, df)
         
         log_activity(admin, "REJECT_USER", {"username": username})
         
@@ -3055,22 +4065,25 @@ async def confirm_delete_stock(callback: types.CallbackQuery):
             await callback.answer("❌ AWS connection not available", show_alert=True)
             return
         
-        objs = s3.list_objects_v2(
-            Bucket=CONFIG["AWS_BUCKET"],
-            Prefix=SUPPLIER_STOCK_FOLDER
+        supplier_keys = await run_blocking(
+            lambda: [obj["Key"] for obj in iter_s3_objects(SUPPLIER_STOCK_FOLDER)]
         )
+        deleted_count = await run_blocking(delete_s3_keys, supplier_keys)
         
-        deleted_count = 0
-        if "Contents" in objs:
-            for obj in objs["Contents"]:
-                s3.delete_object(Bucket=CONFIG["AWS_BUCKET"], Key=obj["Key"])
-                deleted_count += 1
+        try:
+            await run_blocking(delete_s3_keys, [COMBINED_STOCK_PARQUET_KEY, COMBINED_STOCK_KEY, COMBINED_STOCK_CSV_KEY, STOCK_INDEX_KEY])
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to delete combined stock files: {e}")
         
         try:
-            s3.delete_object(Bucket=CONFIG["AWS_BUCKET"], Key=COMBINED_STOCK_KEY)
-        except:
-            pass
+            lock_keys = await run_blocking(
+                lambda: [obj["Key"] for obj in iter_s3_objects(STONE_LOCK_FOLDER)]
+            )
+            await run_blocking(delete_s3_keys, lock_keys)
+        except Exception as e:
+            logger.warning(f"⚠️ Failed to delete stone locks: {e}")
         
+        invalidate_stock_cache()
         log_activity(admin, "DELETE_ALL_STOCK", {"deleted_files": deleted_count})
         
         await callback.message.edit_text(
@@ -3094,43 +4107,41 @@ async def cancel_delete(callback: types.CallbackQuery):
     await callback.answer("Cancelled")
 
 # ============= SUPPLIER STOCK UPLOAD HANDLER =============
-async def handle_supplier_stock_upload(message: types.Message, user: Dict, df: pd.DataFrame, file_path: str, processing_msg: types.Message):
+async def handle_supplier_stock_upload(message: types.Message, user: Dict, df: pd.DataFrame, processing_msg: types.Message):
     """Handle supplier stock upload"""
     try:
         supplier_name = f"supplier_{user['USERNAME'].lower()}"
         validator = DiamondExcelValidator()
-        success, cleaned_df, errors, warnings = validator.validate_and_parse(df, supplier_name)
+        success, cleaned_df, errors, warnings = await run_blocking(validator.validate_and_parse, df, supplier_name)
         
         if not success:
-            error_msg = "❌ **Upload Failed**\n\n"
-            error_msg += "**Errors:**\n"
-            for error in errors[:5]:
-                error_msg += f"• {error}\n"
+            lines = ["❌ **Upload Failed**\n", "**Errors:**"]
+            lines.extend(f"• {error}" for error in errors[:5])
             
             if warnings:
-                error_msg += "\n**Warnings:**\n"
-                for warning in warnings[:3]:
-                    error_msg += f"⚠️ {warning}\n"
+                lines.append("\n**Warnings:**")
+                lines.extend(f"⚠️ {warning}" for warning in warnings[:3])
             
-            error_msg += "\n**Please fix the errors and try again.**"
+            lines.append("\n**Please fix the errors and try again.**")
+            error_msg = "\n".join(lines)
             
             await processing_msg.edit_text(error_msg)
             return
         
         supplier_file = f"{SUPPLIER_STOCK_FOLDER}{supplier_name}.xlsx"
-        temp_supplier_path = f"/tmp/{supplier_name}.xlsx"
-        
-        cleaned_df.to_excel(temp_supplier_path, index=False)
         
         if s3:
-            s3.upload_file(temp_supplier_path, CONFIG["AWS_BUCKET"], supplier_file)
+            await run_blocking(put_excel, cleaned_df, supplier_file)
             logger.info(f"✅ Uploaded {len(cleaned_df)} diamonds for supplier {supplier_name}")
         
-        rebuild_combined_stock()
+        await run_blocking(update_combined_stock, supplier_name, cleaned_df)
+        await run_blocking(save_supplier_schema, supplier_name, df)
         
+        # The validator guarantees numeric Weight/Price Per Carat, so summarise them in one go
         total_stones = len(cleaned_df)
-        total_carats = cleaned_df["Weight"].sum() if "Weight" in cleaned_df.columns else 0
-        total_value = (cleaned_df["Weight"] * cleaned_df["Price Per Carat"]).sum() if "Weight" in cleaned_df.columns and "Price Per Carat" in cleaned_df.columns else 0
+        total_carats = cleaned_df["Weight"].sum()
+        total_value = cleaned_df["Weight"].dot(cleaned_df["Price Per Carat"])
+        price_min, price_avg, price_max = cleaned_df["Price Per Carat"].agg(["min", "mean", "max"])
         
         success_msg = (
             f"✅ **Stock Upload Successful!**\n\n"
@@ -3139,24 +4150,21 @@ async def handle_supplier_stock_upload(message: types.Message, user: Dict, df: p
             f"• ⚖️ Total Carats: {total_carats:.2f}\n"
             f"• 💰 Total Value: ${total_value:,.2f}\n\n"
             f"📈 **Price Range:**\n"
-            f"• Min: ${cleaned_df['Price Per Carat'].min():,.0f}/ct\n"
-            f"• Avg: ${cleaned_df['Price Per Carat'].mean():,.0f}/ct\n"
-            f"• Max: ${cleaned_df['Price Per Carat'].max():,.0f}/ct\n\n"
+            f"• Min: ${price_min:,.0f}/ct\n"
+            f"• Avg: ${price_avg:,.0f}/ct\n"
+            f"• Max: ${price_max:,.0f}/ct\n\n"
         )
         
-        if "Shape" in cleaned_df.columns and not cleaned_df["Shape"].empty:
-            shape_counts = cleaned_df["Shape"].value_counts().head(5)
-            if not shape_counts.empty:
-                success_msg += f"**Shape Distribution:**\n"
-                for shape, count in shape_counts.items():
-                    success_msg += f"• {shape}: {count}\n"
+        shape_counts = cleaned_df["Shape"].value_counts().head(5)
+        if not shape_counts.empty:
+            success_msg += f"**Shape Distribution:**\n"
+            success_msg += "".join(f"• {shape}: {count}\n" for shape, count in shape_counts.items())
         
         success_msg += f"\n🔄 Combined stock has been updated."
         
         if warnings:
             success_msg += "\n\n**Warnings (not critical):**\n"
-            for warning in warnings[:3]:
-                success_msg += f"⚠️ {warning}\n"
+            success_msg += "".join(f"⚠️ {warning}\n" for warning in warnings[:3])
         
         await processing_msg.edit_text(success_msg)
         
@@ -3172,9 +4180,6 @@ async def handle_supplier_stock_upload(message: types.Message, user: Dict, df: p
             "value": float(total_value),
             "warnings": warnings
         })
-        
-        if os.path.exists(temp_supplier_path):
-            os.remove(temp_supplier_path)
             
     except Exception as e:
         logger.error(f"❌ Error in handle_supplier_stock_upload: {e}", exc_info=True)
@@ -0,0 +1,44 @@
+"""Shared fixtures: run main.py against an in-memory S3 bucket provided by moto"""
+import os
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+os.environ.update(
+    BOT_TOKEN="123456:TEST-TOKEN",
+    AWS_ACCESS_KEY_ID="testing",
+    AWS_SECRET_ACCESS_KEY="testing",
+    AWS_BUCKET="test-bucket",
+    AWS_REGION="us-east-1",
+    ENVIRONMENT="development",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_mock = mock_aws()
+_mock.start()
+boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="test-bucket")
+
+import main  # noqa: E402
+
+
+def _reset_caches():
+    main.invalidate_stock_cache()
+    main._SUPPLIER_FRAMES.clear()
+    main._DEAL_CACHE.clear()
+    main._DEALS_INDEX["snapshot"] = None
+
+
+@pytest.fixture
+def s3():
+    """The module's S3 client, with an empty bucket and cold caches for every test"""
+    _reset_caches()
+    yield main.s3
+    keys = [obj["Key"] for obj in main.iter_s3_objects("")]
+    main.delete_s3_keys(keys)
+    _reset_caches()
+
+
+def keys(prefix: str = ""):
+    return sorted(obj["Key"] for obj in main.iter_s3_objects(prefix))
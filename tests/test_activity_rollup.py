@@ -0,0 +1,51 @@
+import orjson
+
+import main
+from conftest import keys
+
+DAY = "2024-01-02"
+
+
+def _entry(action, time="10:00:00"):
+    return {"date": DAY, "time": time, "login_id": "alice", "role": "client", "action": action, "details": {}}
+
+
+def _put_shard(name, entries):
+    key = f"{main.ACTIVITY_LOG_FOLDER}{DAY}/alice/{name}.json"
+    main.s3.put_object(Bucket=main.AWS_BUCKET, Key=key, Body=orjson.dumps(entries))
+    return key
+
+
+def test_rollup_keeps_repeated_events(s3):
+    # The same action at the same second, both within one shard and across shards, is three real events
+    _put_shard("a", [_entry("SEARCH"), _entry("SEARCH")])
+    _put_shard("b", [_entry("SEARCH")])
+
+    main.rollup_activity_logs()
+
+    assert keys(main.ACTIVITY_LOG_FOLDER) == [f"{main.ACTIVITY_ROLLUP_FOLDER}{DAY}.parquet"]
+    report = main.load_activity_report()
+    assert (report["Action"] == "SEARCH").sum() == 3
+
+
+def test_interrupted_rollup_does_not_double_count(s3):
+    shard = [_entry("LOGIN"), _entry("SEARCH", "10:00:05")]
+    _put_shard("a", shard)
+    main.rollup_activity_logs()
+
+    # The previous run wrote the Parquet but died before deleting the shard
+    _put_shard("a", shard)
+    assert len(main.load_activity_report()) == 2
+
+    main.rollup_activity_logs()
+    assert len(main.load_activity_report()) == 2
+
+
+def test_today_is_left_unrolled(s3):
+    today = main.datetime.now(main.IST).strftime("%Y-%m-%d")
+    key = f"{main.ACTIVITY_LOG_FOLDER}{today}/alice/live.json"
+    main.s3.put_object(Bucket=main.AWS_BUCKET, Key=key, Body=orjson.dumps([_entry("LOGIN")]))
+
+    main.rollup_activity_logs()
+
+    assert keys(main.ACTIVITY_LOG_FOLDER) == [key]
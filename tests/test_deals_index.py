@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+
+
+def _deal(i):
+    stone = {"Stock #": f"S{i}", "SUPPLIER": "supplier_acme", "Price Per Carat": 1000}
+    return main.new_deal(stone, f"client{i}", 900.0)
+
+
+def test_append_creates_index(s3):
+    deals = [_deal(1), _deal(2)]
+    main.store_deals(deals)
+
+    index = main.load_deals_index()
+    assert sorted(index["deal_id"]) == sorted(d["deal_id"] for d in deals)
+
+
+def test_concurrent_store_deals_keeps_every_deal(s3):
+    main.store_deals([_deal(0)])
+    deals = [_deal(i) for i in range(1, 9)]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda deal: main.store_deals([deal]), deals))
+
+    main._DEALS_INDEX["snapshot"] = None
+    index = main.load_deals_index()
+    assert len(index) == 9
+    assert set(d["deal_id"] for d in deals) <= set(index["deal_id"])
@@ -0,0 +1,70 @@
+import pandas as pd
+import pytest
+
+import main
+
+
+def _seed(stock_ids):
+    df = pd.DataFrame({"Stock #": stock_ids, "LOCKED": ["NO"] * len(stock_ids)})
+    main.put_excel(df, f"{main.SUPPLIER_STOCK_FOLDER}supplier_acme.xlsx")
+    main.rebuild_combined_stock()
+
+
+def _set_locked(stock_id, value):
+    def build(current):
+        current = current.copy()
+        current.loc[current["Stock #"] == stock_id, "LOCKED"] = value
+        return current
+    return build
+
+
+def _stored():
+    stock = main.load_stock(cached=False)
+    return dict(zip(stock["Stock #"].astype(str), stock["LOCKED"]))
+
+
+def test_conflicting_write_is_retried_on_fresh_stock(s3):
+    _seed(["A1", "B2"])
+    seen = []
+
+    def build(current):
+        if not seen:
+            # Another worker swaps the stock after this one read it
+            _, etag, _ = main.load_stock_snapshot(cached=False)
+            other = main.load_stock(cached=False)[main.COMBINED_STOCK_COLUMNS].copy()
+            other.loc[other["Stock #"] == "B2", "LOCKED"] = "YES"
+            main.save_combined_stock(other, excel_copy=False, IfMatch=etag)
+        seen.append(dict(zip(current["Stock #"], current["LOCKED"])))
+        return _set_locked("A1", "YES")(current)
+
+    main.cas_update_stock(build)
+
+    assert len(seen) == 2
+    assert seen[1]["B2"] == "YES"
+    assert _stored() == {"A1": "YES", "B2": "YES"}
+
+
+def test_build_returning_none_writes_nothing(s3):
+    _seed(["A1"])
+    _, etag, _ = main.load_stock_snapshot(cached=False)
+
+    assert main.cas_update_stock(lambda current: None) is None
+    assert main.load_stock_snapshot(cached=False)[1] == etag
+
+
+def test_gives_up_when_stock_keeps_changing(s3):
+    _seed(["A1"])
+
+    attempts = []
+
+    def build(current):
+        # Every attempt loses the race to a different write that lands between read and swap
+        attempts.append(True)
+        stored, etag, _ = main.load_stock_snapshot(cached=False)
+        other = stored[main.COMBINED_STOCK_COLUMNS].assign(Lab=str(len(attempts)))
+        main.save_combined_stock(other, excel_copy=False, IfMatch=etag)
+        return current
+
+    with pytest.raises(RuntimeError):
+        main.cas_update_stock(build)
+    assert len(attempts) == main.STOCK_CAS_RETRIES
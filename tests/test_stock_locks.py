@@ -0,0 +1,133 @@
+from io import BytesIO
+
+import pandas as pd
+
+import main
+from conftest import keys
+
+SUPPLIER = "supplier_acme"
+
+
+def _upload(stock_ids):
+    """Mimic a supplier upload: write the supplier file, then splice it into the combined stock"""
+    df = pd.DataFrame({
+        "Stock #": stock_ids,
+        "Shape": ["Round"] * len(stock_ids),
+        "Weight": [1.0] * len(stock_ids),
+        "Price Per Carat": [1000.0] * len(stock_ids),
+        "LOCKED": ["NO"] * len(stock_ids),
+    })
+    main.put_excel(df, f"{main.SUPPLIER_STOCK_FOLDER}{SUPPLIER}.xlsx")
+    if main.load_stock(cached=False).empty:
+        main.rebuild_combined_stock()
+    else:
+        main.update_combined_stock(SUPPLIER, df)
+
+
+def _locked():
+    stock = main.load_stock(cached=False)
+    return dict(zip(stock["Stock #"].astype(str), stock["LOCKED"]))
+
+
+def test_lock_is_exclusive_until_unlocked(s3):
+    _upload(["A1", "B2"])
+
+    assert main.lock_stones(["A1"]) == ["A1"]
+    assert main.lock_stones(["A1", "B2"]) == ["B2"]
+    assert _locked() == {"A1": "YES", "B2": "YES"}
+
+    main.unlock_stones(["A1"])
+    assert _locked()["A1"] == "NO"
+    assert keys(main.STONE_LOCK_FOLDER) == [f"{main.STONE_LOCK_FOLDER}B2.json"]
+    assert main.atomic_lock_stone("A1")
+
+
+def test_failed_unlock_still_releases_lock_key(s3, monkeypatch):
+    _upload(["A1"])
+    assert main.atomic_lock_stone("A1")
+
+    def boom(*args, **kwargs):
+        raise RuntimeError("stock write failed")
+
+    monkeypatch.setattr(main, "cas_update_stock", boom)
+    main.unlock_stones(["A1"])
+    assert keys(main.STONE_LOCK_FOLDER) == []
+
+
+def test_reupload_without_locked_stone_releases_its_lock(s3):
+    _upload(["A1", "B2"])
+    assert main.atomic_lock_stone("A1")
+
+    _upload(["B2"])
+    assert keys(main.STONE_LOCK_FOLDER) == []
+
+    _upload(["A1", "B2"])
+    assert main.lock_stones(["A1"]) == ["A1"]
+
+
+def test_removed_stone_can_be_locked_after_reupload(s3):
+    _upload(["A1", "B2"])
+    assert main.atomic_lock_stone("A1")
+
+    main.remove_stones_from_supplier_and_combined(["A1"])
+    assert keys(main.STONE_LOCK_FOLDER) == []
+
+    _upload(["A1", "B2"])
+    assert main.atomic_lock_stone("A1")
+
+
+def _supplier_locked():
+    obj = main.s3.get_object(Bucket=main.AWS_BUCKET, Key=f"{main.SUPPLIER_STOCK_FOLDER}{SUPPLIER}.xlsx")
+    df = main._read_excel(BytesIO(obj["Body"].read()))
+    return dict(zip(df["Stock #"].astype(str), df["LOCKED"]))
+
+
+def test_reupload_keeps_held_locks(s3):
+    _upload(["A1", "B2"])
+    assert main.lock_stones(["A1"]) == ["A1"]
+
+    _upload(["A1", "B2"])
+    assert _locked() == {"A1": "YES", "B2": "NO"}
+    assert _supplier_locked()["A1"] == "YES"
+
+
+def test_lock_taken_during_reupload_survives(s3, monkeypatch):
+    _upload(["A1", "B2"])
+    real_cas = main.cas_update_stock
+    raced = []
+
+    def racing_cas(build, **kwargs):
+        def racing_build(current):
+            # Another deal locks B2 after this upload read the stock but before it writes
+            if not raced:
+                raced.append(True)
+                monkeypatch.setattr(main, "cas_update_stock", real_cas)
+                assert main.lock_stones(["B2"]) == ["B2"]
+            return build(current)
+        return real_cas(racing_build, **kwargs)
+
+    monkeypatch.setattr(main, "cas_update_stock", racing_cas)
+    _upload(["A1", "B2"])
+    assert raced
+    assert _locked() == {"A1": "NO", "B2": "YES"}
+    assert keys(main.STONE_LOCK_FOLDER) == [f"{main.STONE_LOCK_FOLDER}B2.json"]
+
+
+def test_rebuild_keeps_lock_written_by_another_worker(s3):
+    _upload(["A1", "B2"])
+    main.rebuild_combined_stock()
+
+    # Another worker locks A1 in the stored stock; its supplier file mirror has not landed yet
+    stock, etag, _ = main.load_stock_snapshot(cached=False)
+    stock = stock[main.COMBINED_STOCK_COLUMNS].copy()
+    stock.loc[stock["Stock #"] == "A1", "LOCKED"] = "YES"
+    main.save_combined_stock(stock, IfMatch=etag)
+
+    main.rebuild_combined_stock()
+    cached = main.load_stock()
+    assert dict(zip(cached["Stock #"], cached["LOCKED"])) == {"A1": "YES", "B2": "NO"}
+
+    # A full rebuild of changed supplier files must not overwrite the lock either
+    main.put_excel(pd.DataFrame({"Stock #": ["C3"], "LOCKED": ["NO"]}), f"{main.SUPPLIER_STOCK_FOLDER}other.xlsx")
+    main.rebuild_combined_stock()
+    assert _locked() == {"A1": "YES", "B2": "NO", "C3": "NO"}